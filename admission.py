@@ -0,0 +1,137 @@
+"""Ограничение нагрузки на запись в SQLite.
+
+Писатель у SQLite один: при наплыве пользователей запросы выстраиваются
+за блокировкой записи и висят до busy_timeout. ConcurrencyLimiter пускает
+к синхронной записи не больше max_concurrent запросов, ещё queue_size ждут
+не дольше queue_timeout, остальные сразу получают отказ (Overloaded) -
+страница отдаётся из кэша или данных запроса, API отвечает 503.
+TokenBucket ограничивает частоту действий одного пользователя.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """Запрос не допущен к записи: все места заняты, очередь полна или ожидание истекло"""
+
+    def __init__(self, reason, retry_after=1.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """Не больше max_concurrent одновременных операций и queue_size ожидающих.
+
+    Под gevent threading.Semaphore становится зелёным, и ожидание
+    не блокирует event loop.
+    """
+
+    def __init__(self, max_concurrent=4, queue_size=64, queue_timeout=0.25):
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._slots = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.queue_seconds = 0.0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.shed_busy = 0
+
+    @contextmanager
+    def slot(self):
+        """Выполняет блок с занятым местом или поднимает Overloaded"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue_size:
+                    self.shed_queue_full += 1
+                    raise Overloaded('queue full', retry_after=self.queue_timeout * 4)
+                self.waiting += 1
+                self.queued += 1
+            start = time.perf_counter()
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                    self.queue_seconds += time.perf_counter() - start
+            if not acquired:
+                with self._lock:
+                    self.shed_timeout += 1
+                raise Overloaded('queue timeout', retry_after=self.queue_timeout * 4)
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
+
+    def record_busy(self):
+        """Допущенная операция не дождалась чужой блокировки (другой процесс, фоновая запись)"""
+        with self._lock:
+            self.shed_busy += 1
+
+    @property
+    def saturated(self):
+        """Все места заняты: новый запрос встанет в очередь"""
+        return self.active >= self.max_concurrent
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'queue_seconds': self.queue_seconds,
+                'shed': self.shed_queue_full + self.shed_timeout + self.shed_busy,
+                'shed_queue_full': self.shed_queue_full,
+                'shed_timeout': self.shed_timeout,
+                'shed_busy': self.shed_busy,
+            }
+
+
+class TokenBucket:
+    """Маркерная корзина на каждый ключ: rate действий в секунду, не больше burst подряд"""
+
+    def __init__(self, rate=1.0, burst=5, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, key):
+        """0.0, если действие разрешено, иначе через сколько секунд появится маркер"""
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                self.allowed += 1
+                return 0.0
+            bucket[0] = tokens
+            self.limited += 1
+            return (1.0 - tokens) / self.rate
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'allowed': self.allowed, 'limited': self.limited}
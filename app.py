@@ -1,198 +1,438 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, send_from_directory
 import sqlite3
 import requests
 import os
 from urllib.parse import urlencode
-import time
-
-app = Flask(__name__)
+import atexit
+import hmac
+import logging
+import math
+import threading
+from contextlib import contextmanager
+
+try:
+    import redis
+except ImportError:  # Redis - необязательный общий уровень кэша
+    redis = None
+
+from admission import ConcurrencyLimiter, Overloaded, TokenBucket
+from assets import AssetPipeline, install as install_assets
+from avatars import AvatarPipeline
+from bulk import EXPORT_FORMATS, export_chunks, parse_timestamp
+from cache import TwoLevelUserCache, UserCache, UserLookup
+from compression import Compressor, minify_html
+from db import ConnectionPool, is_busy
+from logs import setup as setup_logging
+from metrics import CACHE_LATENCY, DB_LATENCY, install as install_metrics, instrument, register_stats
+from page_cache import PageCache
+from realtime import UserEvents
+from repository import UserRepository
+from sharding import ShardedUserRepository, ShardedWriter
+from warmup import CacheWarmer
+from writer import WriteBehindWriter
+
+# JSON-логи через очередь и фоновый поток; LOG_LEVEL=DEBUG включает подробные сообщения
+log_handler = setup_logging(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    burst=int(os.environ.get('LOG_RATE_BURST', 10)),
+    interval=float(os.environ.get('LOG_RATE_INTERVAL', 60)),
+)
+log = logging.getLogger(__name__)
+
+# TEMPLATE_DIR - каталог шаблонов, если он не рядом с app.py (например, для bench.py load)
+app = Flask(__name__, template_folder=os.environ.get('TEMPLATE_DIR', 'templates'))
 
 # Настройки для производительности
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 300  # Кэширование статических файлов на 5 минут
 
-# Простой кэш пользователей в памяти (для быстрого доступа)
-user_cache = {}
-CACHE_TIMEOUT = 300  # 5 минут
+# Картинки из шаблонов: WebP/AVIF нужного размера по хэшированным URL с годовым кэшем
+ASSET_DIR = os.environ.get('ASSET_DIR', os.path.join(app.root_path, '.assets'))
+asset_pipeline = AssetPipeline(app.root_path, ASSET_DIR)
+install_assets(app, asset_pipeline)
+
+# Сжатие brotli/gzip динамических ответов от COMPRESS_MIN_SIZE байт, кэш сжатых тел
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+compressor = Compressor(app, cache_entries=int(os.environ.get('COMPRESS_CACHE_ENTRIES', 512)))
+
+# Кэш пользователей в памяти: LRU с ограничением размера и TTL
+CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TTL', 300))  # 5 минут
+CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+
+# Общий для всех процессов L2 в Redis (включается переменной REDIS_URL).
+# L1 в этом режиме живёт недолго: инвалидации через pub/sub могут теряться при сбоях Redis
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_L1_TTL = int(os.environ.get('REDIS_L1_TTL', 30))
+if REDIS_URL and redis is not None:
+    user_cache = TwoLevelUserCache(
+        UserCache(max_entries=CACHE_MAX_ENTRIES, ttl=REDIS_L1_TTL),
+        redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5),
+        ttl=CACHE_TIMEOUT,
+    )
+    user_cache.start_listener()
+else:
+    user_cache = UserCache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TIMEOUT)
+
+# Socket.IO: события user_updated в комнату пользователя после каждой записи.
+# С REDIS_URL события рассылаются всем воркерам через Redis.
+# Сокет подписывается только на себя: initData Telegram проверяется токеном бота
+user_events = UserEvents(bot_token=os.environ.get('TELEGRAM_BOT_TOKEN'),
+                         max_auth_age=int(os.environ.get('SOCKET_AUTH_MAX_AGE', 86400)))
+user_events.init_app(app, message_queue=REDIS_URL if REDIS_URL and redis is not None else None)
+
+# Пул соединений с БД: одно соединение на рабочий поток
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# DB_SHARDS=N - пользователи в N файлах по шаблону DB_SHARD_PATTERN (см. sharding.py)
+DB_SHARDS = int(os.environ.get('DB_SHARDS', 0))
+DB_SHARD_PATTERN = os.environ.get('DB_SHARD_PATTERN', 'users-{shard}.db')
+
+# Выгрузка /api/export/users только с заголовком Authorization: Bearer EXPORT_TOKEN; без него маршрут отключён
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN')
+
+# Режим записи визитов: 'behind' - отложенная пакетная запись, 'sync' - сразу в запросе
+USER_WRITE_MODE = os.environ.get('USER_WRITE_MODE', 'behind')
+WRITE_BEHIND_FLUSH_MS = int(os.environ.get('WRITE_BEHIND_FLUSH_MS', 50))
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000))
 
 # База данных
+if DB_SHARDS:
+    user_repo = ShardedUserRepository.open(DB_SHARD_PATTERN, DB_SHARDS, max_size=DB_POOL_SIZE)
+    db_pool = user_repo.pool
+else:
+    db_pool = ConnectionPool(os.environ.get('DB_PATH', 'users.db'), max_size=DB_POOL_SIZE)
+    user_repo = UserRepository(db_pool)
+db_pool.init_app(app)
+# Таймеры на все запросы к БД (до того, как методы репозитория передаются в другие компоненты)
+instrument(user_repo, DB_LATENCY, 'get', 'get_many', 'upsert_visit', 'upsert_visits', 'save', 'set_custom_username',
+           'set_avatar_url', 'row_version')
+
 def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # Создаем таблицу
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER UNIQUE,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            language_code TEXT,
-            avatar_url TEXT,
-            custom_username TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Добавляем поле custom_username если его нет (для существующих баз данных)
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN custom_username TEXT')
-        print("Added custom_username column to existing database")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
-    
-    # Создаем индексы для ускорения запросов
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON users(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_username ON users(username)')
-    
-    # Оптимизируем базу данных
-    cursor.execute('PRAGMA journal_mode=WAL')
-    cursor.execute('PRAGMA synchronous=NORMAL')
-    cursor.execute('PRAGMA cache_size=10000')
-    cursor.execute('PRAGMA temp_store=MEMORY')
-    
-    conn.commit()
-    conn.close()
+    """Инициализация базы данных: применяет миграции схемы"""
+    user_repo.migrate()
+
+def _on_avatar_ready(user_id, avatar_url):
+    """Вызывается фоновым загрузчиком, когда миниатюры аватарки готовы"""
+    user_repo.set_avatar_url(user_id, avatar_url)
+    user_cache.invalidate(user_id)
+    user_events.publish(user_id, avatar_url=avatar_url)
+
+# Аватарки: загрузка через Bot API в фоне, миниатюры WebP в AVATAR_DIR
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+AVATAR_DIR = os.environ.get('AVATAR_DIR', 'avatars')
+avatar_pipeline = AvatarPipeline(
+    TELEGRAM_BOT_TOKEN,
+    storage_dir=AVATAR_DIR,
+    sizes=[int(size) for size in os.environ.get('AVATAR_SIZES', '64,128,256').split(',')],
+    default_size=int(os.environ.get('AVATAR_DEFAULT_SIZE', 128)),
+    api_url=os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org'),
+    on_ready=_on_avatar_ready,
+)
 
 def get_user_avatar_url(user_id):
-    """Получает URL аватарки пользователя из Telegram"""
-    try:
-        # Для получения аватарки пользователя из Telegram нужно использовать Bot API
-        # Но это требует токен бота и может быть ограничено
-        # Пока возвращаем None, в будущем можно реализовать через Telegram Bot API
+    """Получает URL аватарки пользователя из Telegram (синхронно)"""
+    if not avatar_pipeline.enabled:
         return None
+    try:
+        return avatar_pipeline.fetch(user_id)
     except Exception as e:
-        print(f"Ошибка получения аватарки: {e}")
+        log.warning('Ошибка получения аватарки: %s', avatar_pipeline.describe_error(e))
         return None
 
 def save_user_data(user_id, username, first_name, last_name, language_code, avatar_url=None):
     """Сохраняет данные пользователя в базу данных"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
     try:
-        # Если avatar_url не передан, сохраняем существующую аватарку
-        if not avatar_url:
-            cursor.execute('SELECT avatar_url FROM users WHERE user_id = ?', (user_id,))
-            existing_user = cursor.fetchone()
-            if existing_user and existing_user[0]:
-                avatar_url = existing_user[0]
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, first_name, last_name, language_code, avatar_url)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, language_code, avatar_url))
-        conn.commit()
-    except Exception as e:
-        print(f"Ошибка сохранения пользователя: {e}")
-    finally:
-        conn.close()
+        previous = user_lookup.get(user_id)
+        # Если avatar_url не передан, сохраняется существующая аватарка
+        user_repo.save(user_id, username, first_name, last_name, language_code, avatar_url)
+        user_cache.invalidate(user_id)
+        user_data = user_lookup.get(user_id)
+        if user_data is not None:
+            _publish_changes(previous, user_data, PROFILE_FIELDS + ('avatar_url',))
+    except Exception:
+        log.exception('Ошибка сохранения пользователя %s', user_id)
 
 def get_user_data(user_id):
     """Получает данные пользователя из базы данных"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        if user:
-            # Используем custom_username если он есть, иначе username
-            display_username = user[7] if user[7] else user[2]  # custom_username или username
-            
-            return {
-                'user_id': user[1],
-                'username': display_username,  # Показываем правильный юзернейм
-                'original_username': user[2],  # Оригинальный username от бота
-                'custom_username': user[7],     # Кастомный юзернейм
-                'first_name': user[3],
-                'last_name': user[4],
-                'language_code': user[5],
-                'avatar_url': user[6]
-            }
+        return user_repo.get(user_id)
+    except Exception:
+        log.exception('Ошибка получения пользователя %s', user_id)
         return None
-    except Exception as e:
-        print(f"Ошибка получения пользователя: {e}")
-        return None
-    finally:
-        conn.close()
+
+write_behind_options = dict(
+    flush_interval=WRITE_BEHIND_FLUSH_MS / 1000,
+    max_batch=WRITE_BEHIND_MAX_BATCH,
+    max_pending=WRITE_BEHIND_MAX_PENDING,
+    on_flush=lambda batch: _publish_visits(batch),
+)
+if DB_SHARDS:
+    # Свой поток записи на каждый шард: пачки разных файлов пишутся параллельно
+    for shard_repo in user_repo.shards:
+        instrument(shard_repo, DB_LATENCY, 'upsert_visits')
+    user_writer = ShardedWriter([shard_repo.upsert_visits for shard_repo in user_repo.shards],
+                                **write_behind_options)
+else:
+    user_writer = WriteBehindWriter(user_repo.upsert_visits, **write_behind_options)
+# Записываем накопленные изменения при остановке процесса
+atexit.register(user_writer.stop)
+
+# Допуск к синхронной записи: WRITE_CONCURRENCY запросов пишут, до WRITE_QUEUE_SIZE ждут
+# не дольше WRITE_QUEUE_TIMEOUT секунд, остальные получают данные из кэша или 503
+write_limiter = ConcurrencyLimiter(
+    max_concurrent=int(os.environ.get('WRITE_CONCURRENCY', 4)),
+    queue_size=int(os.environ.get('WRITE_QUEUE_SIZE', 64)),
+    queue_timeout=float(os.environ.get('WRITE_QUEUE_TIMEOUT', 0.25)),
+)
+# Допущенная запись ждёт блокировку SQLite (её держит другой процесс или поток отложенной
+# записи) не дольше WRITE_BUSY_TIMEOUT секунд, а не 5 с busy_timeout фоновых записей
+WRITE_BUSY_TIMEOUT = float(os.environ.get('WRITE_BUSY_TIMEOUT', write_limiter.queue_timeout))
+# Смена юзернейма: USERNAME_RATE в секунду на пользователя, подряд не больше USERNAME_BURST
+username_rate_limit = TokenBucket(
+    rate=float(os.environ.get('USERNAME_RATE', 1.0)),
+    burst=int(os.environ.get('USERNAME_BURST', 5)),
+)
+
+def _make_user_data(user_id, username, first_name, last_name, language_code, avatar_url, custom_username,
+                    row_version=None):
+    return {
+        'user_id': user_id,
+        'username': custom_username if custom_username else username,  # Показываем правильный юзернейм
+        'original_username': username,  # Оригинальный от бота
+        'custom_username': custom_username,  # Кастомный юзернейм
+        'first_name': first_name,
+        'last_name': last_name,
+        'language_code': language_code,
+        'avatar_url': avatar_url,
+        'row_version': row_version  # Версия строки в БД (до отложенной записи)
+    }
+
+# Поля события user_updated, которые может изменить визит
+PROFILE_FIELDS = ('username', 'first_name', 'last_name')
+
+def _profile_changes(before, after, fields=PROFILE_FIELDS):
+    """Поля, отличающиеся у записей before и after (before=None - новый пользователь)"""
+    return {field: after[field] for field in fields if before is None or before.get(field) != after[field]}
+
+def _publish_changes(before, after, fields=PROFILE_FIELDS):
+    """Рассылает user_updated только с изменившимися полями; без изменений события нет"""
+    changes = _profile_changes(before, after, fields)
+    if changes:
+        user_events.publish(after['user_id'], **changes)
+
+# Изменения визитов, ждущих отложенной записи: {user_id: {поле: значение}}, рассылаются после коммита
+_pending_changes = {}
+_pending_changes_lock = threading.Lock()
+
+def _publish_visits(batch):
+    """Вызывается после коммита пачки отложенной записи"""
+    with _pending_changes_lock:
+        changes = [(user_id, _pending_changes.pop(user_id, None)) for user_id in batch]
+    for user_id, user_changes in changes:
+        if user_changes:
+            user_events.publish(user_id, **user_changes)
+
+def _with_pending(user_id, user_data):
+    """Накладывает на запись из БД ещё не записанные отложенные изменения"""
+    pending = user_writer.pending_for(user_id)
+    if pending is None:
+        return user_data
+    avatar_url = user_data['avatar_url'] if user_data else None
+    custom_username = user_data['custom_username'] if user_data else None
+    row_version = user_data['row_version'] if user_data else None
+    return _make_user_data(user_id, *pending, avatar_url, custom_username, row_version)
+
+def _load_user(user_id):
+    """Читает пользователя из БД с учётом ещё не записанных отложенных изменений"""
+    return _with_pending(user_id, get_user_data(user_id))
+
+def _load_users(user_ids):
+    """Пакетный вариант _load_user: один запрос WHERE user_id IN (...)"""
+    users = user_repo.get_many(user_ids)
+    loaded = {}
+    for user_id in user_ids:
+        user_data = _with_pending(user_id, users.get(user_id))
+        if user_data is not None:
+            loaded[user_id] = user_data
+    return loaded
+
+# Общий read-through доступ к пользователю для всех страниц и API
+user_lookup = UserLookup(user_cache, _load_user, many_loader=_load_users)
+
+# Кэш отрендеренных страниц (/user, /prof, /glav, /settings, /info) с ETag/304
+page_cache = PageCache(
+    max_entries=int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 2000)),
+    enabled=os.environ.get('PAGE_CACHE_ENABLED', '1') != '0',
+    transform=minify_html,
+)
+user_cache.add_invalidation_listener(page_cache.invalidate_user)
+
+# Прогрев кэша при старте: снимок прошлого запуска (CACHE_SNAPSHOT_PATH) и последние
+# CACHE_WARMUP_USERS пользователей из БД, не дольше CACHE_WARMUP_BUDGET секунд
+cache_warmer = CacheWarmer(
+    user_cache,
+    user_repo,
+    max_users=int(os.environ.get('CACHE_WARMUP_USERS', 5000)),
+    budget=float(os.environ.get('CACHE_WARMUP_BUDGET', 2.0)),
+    snapshot_path=os.environ.get('CACHE_SNAPSHOT_PATH') or None,
+)
+
+# Метрики Prometheus на /metrics; PROFILING_ENABLED=1 - профиль запроса по ?_profile=1
+install_metrics(app, profiling=os.environ.get('PROFILING_ENABLED') == '1')
+instrument(user_cache, CACHE_LATENCY, 'get', 'get_many', 'set', 'invalidate', cache='user')
+instrument(user_lookup, CACHE_LATENCY, 'get', 'get_many', cache='user_lookup')
+register_stats('user_cache', user_cache.stats,
+               counters=('hits', 'misses', 'evictions', 'expirations', 'invalidations', 'l2_hits', 'l2_misses',
+                         'l2_errors', 'remote_invalidations'))
+register_stats('user_lookup', user_lookup.stats, counters=('loads', 'coalesced'))
+register_stats('page_cache', page_cache.stats,
+               counters=('hits', 'misses', 'not_modified', 'evictions', 'invalidations', 'render_seconds_saved'))
+register_stats('compression', compressor.stats, counters=('hits', 'misses', 'bytes_in', 'bytes_out'))
+register_stats('db_pool', db_pool.stats, counters=('opened', 'waits', 'wait_seconds', 'locked_errors'))
+register_stats('write_behind', user_writer.stats,
+               counters=('submitted', 'coalesced', 'rejected', 'flushes', 'flushed_rows', 'errors'))
+register_stats('avatars', avatar_pipeline.stats, counters=('fetched', 'missing', 'failed', 'dropped'))
+register_stats('logging', log_handler.stats, counters=('dropped', 'suppressed'))
+register_stats('realtime', user_events.stats, counters=('rejected', 'subscriptions', 'published'))
+register_stats('cache_warmup', cache_warmer.stats)
+register_stats('write_admission', write_limiter.stats,
+               counters=('admitted', 'queued', 'queue_seconds', 'shed', 'shed_queue_full', 'shed_timeout',
+                         'shed_busy'))
+register_stats('username_rate_limit', username_rate_limit.stats, counters=('allowed', 'limited'))
 
 def save_and_get_user_data(user_id, username, first_name, last_name, language_code):
     """Оптимизированная функция: сохраняет и сразу возвращает данные пользователя"""
+    user_data = _save_and_get_user_data(user_id, username, first_name, last_name, language_code)
+    if user_data is not None and not user_data.get('avatar_url'):
+        # Аватарки ещё нет - загружаем в фоне, страница не ждёт
+        avatar_pipeline.enqueue(user_id)
+    return user_data
+
+def _save_and_get_user_data(user_id, username, first_name, last_name, language_code):
     # Проверяем кэш
-    cache_key = str(user_id)
-    current_time = time.time()
+    cache_data = user_cache.get(user_id)
     
-    if cache_key in user_cache:
-        cache_data, cache_time = user_cache[cache_key]
-        if current_time - cache_time < CACHE_TIMEOUT:
-            # Проверяем, нужно ли обновлять данные
-            should_update = (
-                cache_data['original_username'] != username or 
-                cache_data['first_name'] != first_name or 
-                cache_data['last_name'] != last_name or 
-                cache_data['language_code'] != language_code
-            )
-            
-            if should_update:
-                # Обновляем в БД и кэше
-                return _update_user_in_db_and_cache(user_id, username, first_name, last_name, language_code)
-            return cache_data
+    if cache_data is not None:
+        # Проверяем, нужно ли обновлять данные
+        should_update = (
+            cache_data['original_username'] != username or 
+            cache_data['first_name'] != first_name or 
+            cache_data['last_name'] != last_name or 
+            cache_data['language_code'] != language_code
+        )
+        
+        if should_update:
+            # Обновляем в БД и кэше
+            return _update_user_in_db_and_cache(user_id, username, first_name, last_name, language_code)
+        return cache_data
     
     # Если нет в кэше, получаем из БД
     return _update_user_in_db_and_cache(user_id, username, first_name, last_name, language_code)
 
 def _update_user_in_db_and_cache(user_id, username, first_name, last_name, language_code):
-    """Обновляет данные пользователя в БД и кэше"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    """Обновляет кэш сразу, а запись в БД откладывает (если включён режим 'behind')"""
+    if USER_WRITE_MODE != 'behind':
+        return _update_user_in_db_and_cache_sync(user_id, username, first_name, last_name, language_code)
+    
+    # avatar_url и custom_username берём из кэша/БД, визит их не меняет
+    existing_user = user_lookup.get(user_id)
+    if existing_user is not None and (existing_user['original_username'], existing_user['first_name'],
+                                      existing_user['last_name'], existing_user['language_code']) == \
+            (username, first_name, last_name, language_code):
+        # Данные от бота не изменились (промах кэша после TTL или деплоя): писать и рассылать нечего
+        return existing_user
+    # Поколение берётся после инвалидации и до чтения: если /api/username запишет новое имя
+    # до нашего set(), set() пропускается и в кэш не вернётся старый custom_username.
+    # Читаем из БД напрямую: загрузка в UserLookup могла начаться до инвалидации
+    user_cache.invalidate(user_id)
+    generation = user_cache.generation
+    existing_user = _load_user(user_id)
+    avatar_url = existing_user['avatar_url'] if existing_user else None
+    custom_username = existing_user['custom_username'] if existing_user else None
+    row_version = existing_user['row_version'] if existing_user else None
+    user_data = _make_user_data(user_id, username, first_name, last_name, language_code, avatar_url, custom_username,
+                                row_version)
     
+    # Изменения запоминаются до submit: пачка может записаться раньше, чем submit вернётся
+    changes = _profile_changes(existing_user, user_data)
+    if changes:
+        with _pending_changes_lock:
+            _pending_changes.setdefault(user_id, {}).update(changes)
+    if not user_writer.submit(user_id, (username, first_name, last_name, language_code)):
+        # Очередь переполнена - пишем синхронно (backpressure), событие рассылает синхронная запись
+        with _pending_changes_lock:
+            _pending_changes.pop(user_id, None)
+        return _update_user_in_db_and_cache_sync(user_id, username, first_name, last_name, language_code)
+    
+    user_cache.set(user_id, user_data, generation=generation)
+    return user_data
+
+@contextmanager
+def _write_slot():
+    """Место в write_limiter; занятая БД (блокировка записи, пул) - тоже перегрузка, остальные ошибки - нет"""
+    with write_limiter.slot():
+        try:
+            with db_pool.busy_timeout(WRITE_BUSY_TIMEOUT):
+                yield
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            write_limiter.record_busy()
+            raise Overloaded(f'database busy: {e}', retry_after=1.0) from e
+
+def _degraded_user_data(user_id, username, first_name, last_name, language_code, cached):
+    """Данные для страницы без записи в БД: аватарка и custom_username из кэша или БД, остальное из запроса"""
+    if cached is None:
+        try:
+            # Чтение в WAL не ждёт писателя
+            cached = user_lookup.get(user_id)
+        except Exception:
+            log.warning('Пользователь %s не прочитан, страница из данных запроса', user_id)
+    if cached is None:
+        return _make_user_data(user_id, username, first_name, last_name, language_code, None, None)
+    return _make_user_data(user_id, username, first_name, last_name, language_code, cached['avatar_url'],
+                           cached['custom_username'], cached['row_version'])
+
+def _update_user_in_db_and_cache_sync(user_id, username, first_name, last_name, language_code):
+    """Обновляет данные пользователя в БД и кэше"""
+    # Запоминаем до инвалидации: при перегрузке страница строится из этой записи
+    cached = user_cache.get(user_id)
     try:
-        # Получаем существующие данные
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        existing_user = cursor.fetchone()
-        
-        # Сохраняем аватарку и custom_username если они есть
-        avatar_url = existing_user[6] if existing_user and existing_user[6] else None
-        custom_username = existing_user[7] if existing_user and existing_user[7] else None
+        # Один UPSERT: avatar_url и custom_username не трогаются, username всегда обновляется от бота
+        with _write_slot():
+            user_cache.invalidate(user_id)
+            generation = user_cache.generation
+            previous, user_data = user_repo.upsert_visit(user_id, username, first_name, last_name, language_code)
         
-        # Обновляем/создаем запись - username всегда обновляется от бота
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, first_name, last_name, language_code, avatar_url, custom_username)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, language_code, avatar_url, custom_username))
+        # Сохраняем в кэш, если запись не изменили после нашего UPSERT (например, /api/username)
+        user_cache.set(user_id, user_data, generation=generation)
+        _publish_changes(previous, user_data)
         
-        conn.commit()
-        
-        # Определяем, какой username показывать
-        display_username = custom_username if custom_username else username
-        
-        # Данные пользователя
-        user_data = {
-            'user_id': user_id,
-            'username': display_username,  # Показываем правильный юзернейм
-            'original_username': username,  # Оригинальный от бота
-            'custom_username': custom_username,  # Кастомный юзернейм
-            'first_name': first_name,
-            'last_name': last_name,
-            'language_code': language_code,
-            'avatar_url': avatar_url
-        }
-        
-        # Сохраняем в кэш
-        user_cache[str(user_id)] = (user_data, time.time())
-        
-        print(f"Updated user {user_id}: display_username={display_username}, original={username}, custom={custom_username}")
+        log.debug('Updated user %s: display_username=%s, original=%s, custom=%s',
+                  user_id, user_data['username'], username, user_data['custom_username'])
         return user_data
-    except Exception as e:
-        print(f"Ошибка сохранения/получения пользователя: {e}")
+    except Overloaded as e:
+        # Писатель перегружен: страница не ждёт, визит запишется при следующем заходе
+        log.warning('Запись визита пользователя отложена: %s', e.reason)
+        return _degraded_user_data(user_id, username, first_name, last_name, language_code, cached)
+    except Exception:
+        log.exception('Ошибка сохранения/получения пользователя %s', user_id)
         return None
-    finally:
-        conn.close()
+
+def _render_user_page(template, user_data, user_id, username, lang, **context):
+    """Страница пользователя через page_cache.
+
+    Для известного пользователя юзернейм, имя и фамилия берутся из БД, а не из
+    запроса: страница определяется (шаблон, lang, user_id, row_version) и кэшируется.
+    Для неизвестного - значения из запроса, без кэша.
+    """
+    if user_data:
+        user_id = str(user_data['user_id'])
+        username = user_data.get('username')
+        for field in ('first_name', 'last_name'):
+            if field in context:
+                context[field] = user_data.get(field) or ''
+    return page_cache.render(template, lang=lang, user_data=user_data, username=username, user_id=user_id,
+                             **context)
 
 @app.route('/')
 def index():
@@ -217,7 +457,7 @@ def index():
     final_username = username
     if user_data and user_data.get('username'):
         final_username = user_data['username']
-        print(f"Using username from database for /: {final_username}")
+        log.debug('Using username from database for /: %s', final_username)
     
     return render_template('index.html', 
                          username=final_username, 
@@ -239,20 +479,16 @@ def user():
     if user_id:
         try:
             user_id_int = int(user_id)
-            user_data = get_user_data(user_id_int)
+            user_data = user_lookup.get(user_id_int)
             
             if user_data and user_data.get('username'):
                 # Если в базе есть более свежий юзернейм, используем его
                 final_username = user_data['username']
-                print(f"Using username from database for /user: {final_username}")
+                log.debug('Using username from database for /user: %s', final_username)
         except (ValueError, TypeError):
-            print(f"Invalid user_id: {user_id}")
+            log.info('Invalid user_id: %s', user_id)
     
-    return render_template('user.html', 
-                         username=final_username, 
-                         user_id=user_id, 
-                         lang=lang,
-                         user_data=user_data)
+    return _render_user_page('user.html', user_data, user_id, final_username, lang)
 
 @app.route('/tonconnect_page')
 def tonconnect_page():
@@ -282,7 +518,7 @@ def tonconnect_page():
     final_username = username
     if user_data and user_data.get('username'):
         final_username = user_data['username']
-        print(f"Using username from database for /tonconnect_page: {final_username}")
+        log.debug('Using username from database for /tonconnect_page: %s', final_username)
     
     return render_template('tonconect.html', 
                          username=final_username, 
@@ -310,29 +546,23 @@ def prof():
     if user_id:
         try:
             user_id_int = int(user_id)
-            user_data = get_user_data(user_id_int)
+            user_data = user_lookup.get(user_id_int)
             
             if user_data:
                 # Если в базе есть более свежий юзернейм, используем его
                 if user_data.get('username'):
                     final_username = user_data['username']
-                    print(f"Using username from database: {final_username}")
+                    log.debug('Using username from database: %s', final_username)
                 else:
-                    print(f"No username in database, using provided: {username}")
+                    log.debug('No username in database, using provided: %s', username)
                 
                 if user_data.get('avatar_url'):
                     avatar_url = user_data['avatar_url']
         except (ValueError, TypeError):
-            print(f"Invalid user_id: {user_id}")
+            log.info('Invalid user_id: %s', user_id)
     
-    return render_template('prof.html', 
-                         username=final_username, 
-                         user_id=user_id, 
-                         first_name=first_name,
-                         last_name=last_name,
-                         lang=lang,
-                         user_data=user_data,
-                         avatar_url=avatar_url)
+    return _render_user_page('prof.html', user_data, user_id, final_username, lang,
+                             first_name=first_name, last_name=last_name, avatar_url=avatar_url)
 
 @app.route('/profile')
 def profile_alias():
@@ -354,18 +584,13 @@ def glav():
     lang = request.args.get('lang', 'ru')
 
     # Загружаем пользователя если есть ID
-    user_data = get_user_data(int(user_id)) if user_id else None
+    user_data = user_lookup.get(int(user_id)) if user_id else None
     final_username = username
     if user_data and user_data.get('username'):
         final_username = user_data['username']
 
-    return render_template('glav.html',
-                           username=final_username,
-                           user_id=user_id,
-                           first_name=first_name,
-                           last_name=last_name,
-                           lang=lang,
-                           user_data=user_data)
+    return _render_user_page('glav.html', user_data, user_id, final_username, lang,
+                             first_name=first_name, last_name=last_name)
 
 
 @app.route('/settings')
@@ -377,18 +602,13 @@ def settings_page():
     last_name = request.args.get('last_name', '')
     lang = request.args.get('lang', 'ru')
 
-    user_data = get_user_data(int(user_id)) if user_id else None
+    user_data = user_lookup.get(int(user_id)) if user_id else None
     final_username = username
     if user_data and user_data.get('username'):
         final_username = user_data['username']
 
-    return render_template('settings.html',
-                           username=final_username,
-                           user_id=user_id,
-                           first_name=first_name,
-                           last_name=last_name,
-                           lang=lang,
-                           user_data=user_data)
+    return _render_user_page('settings.html', user_data, user_id, final_username, lang,
+                             first_name=first_name, last_name=last_name)
 
 
 @app.route('/info')
@@ -400,84 +620,77 @@ def info_page():
     last_name = request.args.get('last_name', '')
     lang = request.args.get('lang', 'ru')
 
-    user_data = get_user_data(int(user_id)) if user_id else None
+    user_data = user_lookup.get(int(user_id)) if user_id else None
     final_username = username
     if user_data and user_data.get('username'):
         final_username = user_data['username']
 
-    return render_template('info.html',
-                           username=final_username,
-                           user_id=user_id,
-                           first_name=first_name,
-                           last_name=last_name,
-                           lang=lang,
-                           user_data=user_data)
+    return _render_user_page('info.html', user_data, user_id, final_username, lang,
+                             first_name=first_name, last_name=last_name)
 @app.route('/api/user/<int:user_id>/username')
 def get_username(user_id):
     """API для получения актуального юзернейма пользователя"""
     try:
-        user_data = get_user_data(user_id)
+        user_data = user_lookup.get(user_id)
         if user_data and user_data.get('username'):
             return jsonify({'username': user_data['username']})
         else:
             return jsonify({'username': None})
-    except Exception as e:
-        print(f"Error getting username: {e}")
+    except Exception:
+        log.exception('Error getting username for %s', user_id)
         return jsonify({'username': None})
 
+def _retry_later(error, status, retry_after):
+    """Ответ 429/503 с Retry-After в целых секундах"""
+    response = jsonify({'ok': False, 'error': error})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
 @app.route('/api/username', methods=['POST'])
 def update_username():
     """API для обновления юзернейма"""
     try:
         data = request.get_json()
-        print(f"Received data: {data}")
+        log.debug('Received username update: %s', data)
         user_id = data.get('user_id')
         username = data.get('username')
         
         if not user_id or not username:
-            print(f"Missing data: user_id={user_id}, username={username}")
+            log.info('Missing data: user_id=%s, username=%s', user_id, username)
             return jsonify({'ok': False, 'error': 'Missing user_id or username'})
         
-        # Обновляем юзернейм в базе данных
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
         # Преобразуем user_id в число
         try:
             user_id = int(user_id)
-            print(f"Converted user_id to int: {user_id}")
+            log.debug('Converted user_id to int: %s', user_id)
         except (ValueError, TypeError):
-            print(f"Invalid user_id: {user_id}")
+            log.info('Invalid user_id: %s', user_id)
             return jsonify({'ok': False, 'error': 'Invalid user_id'})
         
-        # Проверяем, существует ли пользователь
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        existing_user = cursor.fetchone()
-        print(f"Existing user: {existing_user}")
-        
-        if existing_user:
-            # Обновляем существующего пользователя - сохраняем в custom_username
-            print(f"Updating user {user_id} with custom username {username}")
-            cursor.execute('UPDATE users SET custom_username = ? WHERE user_id = ?', (username, user_id))
-        else:
-            # Создаем нового пользователя
-            print(f"Creating new user {user_id} with custom username {username}")
-            cursor.execute('INSERT INTO users (user_id, custom_username) VALUES (?, ?)', (user_id, username))
+        retry_after = username_rate_limit.take(user_id)
+        if retry_after:
+            return _retry_later('Too many username changes', 429, retry_after)
         
-        conn.commit()
-        conn.close()
+        # Обновляем юзернейм в базе данных
+        # Создаем пользователя или обновляем custom_username одним UPSERT
+        log.debug('Saving custom username %s for user %s', username, user_id)
+        with _write_slot():
+            user_repo.set_custom_username(user_id, username)
         
-        # Обновляем кэш
-        if user_id in user_cache:
-            user_cache[user_id]['username'] = username
-            user_cache[user_id]['username_edited'] = True  # Помечаем, что юзернейм был отредактирован
-            print(f"Updated cache for user {user_id}")
+        # Сбрасываем кэш: следующее чтение возьмёт custom_username из БД
+        user_cache.invalidate(user_id)
+        user_events.publish(user_id, username=username)
+        log.debug('Invalidated cache for user %s', user_id)
         
-        print(f"Successfully updated username to: {username}")
+        log.info('Updated custom username for user %s', user_id)
         return jsonify({'ok': True, 'username': username})
         
-    except Exception as e:
-        print(f"Error updating username: {e}")
+    except Overloaded as e:
+        log.warning('Username update shed: %s', e.reason)
+        return _retry_later('Server busy, try again later', 503, e.retry_after)
+    except Exception:
+        log.exception('Error updating username')
         return jsonify({'ok': False, 'error': 'Internal server error'})
 
 
@@ -493,7 +706,7 @@ def deepseek():
     user_data = None
     avatar_url = None
     if user_id:
-        user_data = get_user_data(int(user_id))
+        user_data = user_lookup.get(int(user_id))
         if user_data and user_data.get('avatar_url'):
             avatar_url = user_data['avatar_url']
     
@@ -507,18 +720,137 @@ def deepseek():
 @app.route('/api/user/<int:user_id>/avatar')
 def get_user_avatar(user_id):
     """API для получения аватарки пользователя"""
-    user_data = get_user_data(user_id)
+    user_data = user_lookup.get(user_id)
     if user_data and user_data.get('avatar_url'):
         return jsonify({'avatar_url': user_data['avatar_url']})
     return jsonify({'avatar_url': None})
 
+# Поля, которые можно запросить в /api/users: только публичные, как у /username и /avatar.
+# Маршрут без авторизации, имена и язык пользователей через него не отдаются
+USER_API_FIELDS = ('username', 'avatar_url')
+USER_API_DEFAULT_FIELDS = USER_API_FIELDS
+USERS_BATCH_MAX = int(os.environ.get('USERS_BATCH_MAX', 500))
+
+@app.route('/api/users', methods=['GET', 'POST'])
+def get_users():
+    """Пакетное получение пользователей.
+
+    GET /api/users?ids=1,2,3&fields=username,avatar_url
+    POST /api/users {"ids": [1, 2, 3], "fields": ["username"]}
+    Ответ: {"users": {"1": {...}, "2": null}} - null для неизвестных id.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'ok': False, 'error': 'Invalid body'}), 400
+        ids, fields = data.get('ids') or [], data.get('fields')
+        if not isinstance(ids, list):
+            return jsonify({'ok': False, 'error': 'Invalid ids'}), 400
+    else:
+        ids = [part for part in request.args.get('ids', '').split(',') if part]
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else None
+
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in ids))
+    except (ValueError, TypeError):
+        return jsonify({'ok': False, 'error': 'Invalid ids'}), 400
+    if not user_ids:
+        return jsonify({'ok': False, 'error': 'Missing ids'}), 400
+    if len(user_ids) > USERS_BATCH_MAX:
+        return jsonify({'ok': False, 'error': f'Too many ids (max {USERS_BATCH_MAX})'}), 400
+    fields = tuple(fields) if fields else USER_API_DEFAULT_FIELDS
+    unknown = [field for field in fields if field not in USER_API_FIELDS]
+    if unknown:
+        return jsonify({'ok': False, 'error': f"Unknown fields: {', '.join(map(str, unknown))}"}), 400
+
+    try:
+        found = user_lookup.get_many(user_ids)
+    except Exception:
+        log.exception('Error getting users batch')
+        return jsonify({'ok': False, 'error': 'Internal server error'}), 500
+    users = {}
+    for user_id in user_ids:
+        user_data = found.get(user_id)
+        users[str(user_id)] = {field: user_data.get(field) for field in fields} if user_data else None
+    return jsonify({'users': users})
+
+@app.route('/api/export/users')
+def export_users():
+    """Потоковая выгрузка пользователей по возрастанию user_id (см. bulk.py).
+
+    GET /api/export/users?format=csv&created_after=2024-01-01&created_before=2024-02-01
+    Прерванную выгрузку можно продолжить с ?after=<последний user_id>; limit ограничивает число строк.
+    """
+    if not EXPORT_TOKEN:
+        return jsonify({'ok': False, 'error': 'Not found'}), 404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {EXPORT_TOKEN}'.encode()):
+        return jsonify({'ok': False, 'error': 'Unauthorized'}), 401
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'ok': False, 'error': f"Unknown format (use {', '.join(EXPORT_FORMATS)})"}), 400
+    try:
+        created_after = parse_timestamp(request.args.get('created_after'))
+        created_before = parse_timestamp(request.args.get('created_before'))
+        after = int(request.args.get('after', 0))
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Invalid created_after, created_before, after or limit'}), 400
+    if after < 0 or (limit is not None and limit < 0):
+        return jsonify({'ok': False, 'error': 'after and limit must not be negative'}), 400
+
+    paths = [pool.path for pool in db_pool.pools] if DB_SHARDS else [db_pool.path]
+    # Страницы читаются из снимка БД в пуле потоков, пока клиент принимает предыдущие
+    chunks = export_chunks(fmt, paths, after=after, created_after=created_after, created_before=created_before,
+                           limit=limit, run=db_pool.run_blocking)
+    # NDJSON и CSV не входят в COMPRESS_MIMETYPES: Flask-Compress не собирает поток в память
+    response = Response(chunks, mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=users.{fmt}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/ready')
+def ready():
+    """Готовность к трафику: БД инициализирована, прогрев кэша завершён или исчерпал бюджет"""
+    warmup = cache_warmer.stats()
+    is_ready = _app_initialized and warmup['done']
+    return jsonify({'ready': is_ready, 'warmup': warmup}), 200 if is_ready else 503
+
+@app.route('/avatars/<path:filename>')
+def avatar_file(filename):
+    """Миниатюры аватарок: имя файла содержит хэш, поэтому кэшируются навсегда"""
+    response = send_from_directory(os.path.abspath(AVATAR_DIR), filename, max_age=31536000, etag=True,
+                                   conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
+def create_app():
+    """Фабрика приложения: инициализирует БД ровно один раз на процесс"""
+    global _app_initialized
+    with _app_init_lock:
+        if not _app_initialized:
+            init_db()
+            _app_initialized = True
+            cache_warmer.start()
+    return app
+
+def shutdown():
+    """Корректная остановка: запись отложенных изменений, снимка кэша и закрытие соединений"""
+    user_writer.stop()
+    cache_warmer.save_snapshot()
+    db_pool.close_all()
+
 if __name__ == '__main__':
-    init_db()
-    # Оптимизированные настройки для продакшена
-    app.run(
+    # Сервер разработки; для продакшена - python wsgi.py
+    create_app().run(
         host='0.0.0.0', 
-        port=8000, 
+        port=int(os.environ.get('PORT', 8000)), 
         debug=False,  # Отключаем debug для производительности
         threaded=True,  # Включаем многопоточность
         use_reloader=False  # Отключаем автоперезагрузку
-    )
\ No newline at end of file
+    )
+    shutdown()
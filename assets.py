@@ -0,0 +1,216 @@
+"""Оптимизация статических изображений и раздача по хэшированным именам.
+
+Ссылки вида src="paragraph.png" в шаблонах заменяются на /assets/paragraph.<hash>.
+По этому адресу отдаётся лучший формат, который принимает клиент (AVIF, WebP
+или исходный), уменьшенный до ширины, с которой картинка реально показывается.
+Варианты кодируются лениво при первом запросе или заранее: python assets.py build
+"""
+import hashlib
+import io
+import os
+import re
+import sys
+import threading
+
+from flask import abort, request, send_file
+from jinja2 import BaseLoader
+from PIL import Image
+
+try:
+    import pillow_avif  # noqa: F401  Плагин AVIF для Pillow, если установлен
+except ImportError:
+    pass
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Ширина вывода в CSS-пикселях x2 для retina-экранов; остальные картинки - логотипы 150px
+DISPLAY_WIDTHS = {
+    'halvawhite.webp': 800,
+    'halvablack.webp': 800,
+    'halvagreen.jpg': 800,
+}
+DEFAULT_WIDTH = 300
+
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'png': 'image/png', 'jpeg': 'image/jpeg'}
+
+_REFERENCE_RE = re.compile(
+    r'''(?P<prefix>(?:src|href)=(?P<quote>["'])|url\((?P<urlquote>["']?))'''
+    r'''(?P<name>[\w.-]+\.(?:png|jpe?g|webp))'''
+    r'''(?=(?(quote)(?P=quote)|(?P=urlquote)\)))''',
+    re.IGNORECASE,
+)
+
+
+def _source_format(name):
+    ext = os.path.splitext(name)[1].lower()
+    return 'jpeg' if ext in ('.jpg', '.jpeg') else ext[1:]
+
+
+class AssetPipeline:
+    def __init__(self, source_dir, output_dir='.assets', url_prefix='/assets', quality=80):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.url_prefix = url_prefix
+        self.quality = quality
+        Image.init()
+        self.formats = ['avif', 'webp'] if 'AVIF' in Image.SAVE else ['webp']
+        self._names = None
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def _images(self):
+        if self._names is None:
+            self._names = frozenset(name for name in os.listdir(self.source_dir)
+                                    if name.lower().endswith(IMAGE_EXTENSIONS))
+        return self._names
+
+    def _width(self, name):
+        return DISPLAY_WIDTHS.get(name, DEFAULT_WIDTH)
+
+    def hashed_name(self, name):
+        """paragraph.png -> paragraph.<hash>; hash учитывает содержимое и настройки"""
+        hashed = self._hashes.get(name)
+        if hashed is None:
+            with open(os.path.join(self.source_dir, name), 'rb') as f:
+                digest = hashlib.sha256(f.read())
+            digest.update(f'{self._width(name)}:{self.quality}'.encode())
+            hashed = self._hashes[name] = f'{os.path.splitext(name)[0]}.{digest.hexdigest()[:12]}'
+        return hashed
+
+    def url(self, name):
+        return f'{self.url_prefix}/{self.hashed_name(name)}'
+
+    def rewrite(self, html):
+        """Заменяет ссылки на локальные картинки хэшированными URL"""
+        available = self._images()
+
+        def replace(match):
+            name = match.group('name')
+            if name not in available:
+                return match.group(0)
+            return match.group('prefix') + self.url(name)
+
+        return _REFERENCE_RE.sub(replace, html)
+
+    def resolve(self, hashed):
+        """Исходное имя по хэшированному или None (устаревший/неизвестный хэш)"""
+        stem = hashed.rsplit('.', 1)[0]
+        for name in self._images():
+            if os.path.splitext(name)[0] == stem and self.hashed_name(name) == hashed:
+                return name
+        return None
+
+    def negotiate(self, name, accept):
+        """Лучший формат из заголовка Accept; исходный формат подходит всегда"""
+        accept = accept or ''
+        for fmt in self.formats:
+            if MIME_TYPES[fmt] in accept:
+                return fmt
+        return _source_format(name)
+
+    def variant_path(self, name, fmt):
+        """Путь к варианту картинки в формате fmt; кодирует при первом обращении"""
+        path = os.path.join(self.output_dir, f'{self.hashed_name(name)}.{fmt}')
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            lock = self._build_locks.setdefault(path, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                self._encode(name, fmt, path)
+        return path
+
+    def _encode(self, name, fmt, path):
+        source_path = os.path.join(self.source_dir, name)
+        with open(source_path, 'rb') as f:
+            source_bytes = f.read()
+        image = Image.open(io.BytesIO(source_bytes))
+        width = self._width(name)
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        if fmt == 'png':
+            image.save(out, 'PNG', optimize=True)
+        elif fmt == 'jpeg':
+            image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+        elif fmt == 'webp':
+            image.save(out, 'WEBP', quality=self.quality, method=6)
+        else:
+            image.save(out, 'AVIF', quality=self.quality)
+        data = out.getvalue()
+        if fmt == _source_format(name) and len(data) >= len(source_bytes):
+            # Перекодирование не помогло - отдаём исходный файл
+            data = source_bytes
+        os.makedirs(self.output_dir, exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def build(self):
+        """Кодирует все варианты всех картинок заранее"""
+        for name in sorted(self._images()):
+            for fmt in {*self.formats, _source_format(name)}:
+                self.variant_path(name, fmt)
+
+    def report(self, pages):
+        """Байты картинок на страницу: исходные против лучшего варианта"""
+        rows = []
+        for page in pages:
+            with open(page, encoding='utf-8') as f:
+                html = f.read()
+            names = sorted({m.group('name') for m in _REFERENCE_RE.finditer(html)} & self._images())
+            before = sum(os.path.getsize(os.path.join(self.source_dir, name)) for name in names)
+            after = sum(min(os.path.getsize(self.variant_path(name, fmt))
+                            for fmt in {*self.formats, _source_format(name)}) for name in names)
+            rows.append((os.path.basename(page), len(names), before, after))
+        return rows
+
+
+def install(app, pipeline):
+    """Подключает маршрут /assets и переписывание ссылок в шаблонах Flask"""
+    class RewritingLoader(BaseLoader):
+        # Переписываем исходник шаблона один раз: Jinja кэширует скомпилированный результат
+        def __init__(self, loader):
+            self.loader = loader
+
+        def get_source(self, environment, template):
+            source, filename, uptodate = self.loader.get_source(environment, template)
+            return pipeline.rewrite(source), filename, uptodate
+
+        def list_templates(self):
+            return self.loader.list_templates()
+
+    app.jinja_env.loader = RewritingLoader(app.jinja_env.loader)
+
+    @app.route(f'{pipeline.url_prefix}/<hashed>')
+    def asset(hashed):
+        name = pipeline.resolve(hashed)
+        if name is None:
+            abort(404)
+        fmt = pipeline.negotiate(name, request.headers.get('Accept'))
+        response = send_file(pipeline.variant_path(name, fmt), mimetype=MIME_TYPES[fmt],
+                             etag=True, conditional=True, max_age=31536000)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.vary.add('Accept')
+        return response
+
+
+def main():
+    root = os.path.dirname(os.path.abspath(__file__))
+    pipeline = AssetPipeline(root, os.environ.get('ASSET_DIR', os.path.join(root, '.assets')))
+    if len(sys.argv) < 2 or sys.argv[1] not in ('build', 'report'):
+        sys.exit('usage: python assets.py build|report')
+    pipeline.build()
+    pages = [os.path.join(root, name) for name in sorted(os.listdir(root)) if name.endswith('.html')]
+    for page, count, before, after in pipeline.report(pages):
+        if count:
+            print(f"{page:<24} {count:3} images  {before / 1024:8.1f} KiB -> {after / 1024:8.1f} KiB  "
+                  f"saved {(before - after) / 1024:8.1f} KiB ({(1 - after / before) * 100:.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Фоновая загрузка аватарок пользователей из Telegram и миниатюры WebP"""
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from PIL import Image, ImageOps
+
+log = logging.getLogger(__name__)
+
+
+class AvatarPipeline:
+    """Загружает фото профиля через Bot API и сохраняет миниатюры на диск.
+
+    enqueue() не блокирует запрос: загрузку выполняют фоновые потоки.
+    Файлы называются по хэшу исходного изображения ({hash}-{size}.webp),
+    поэтому одинаковые фото хранятся один раз, а URL можно кэшировать навсегда.
+    Готовый URL (размер default_size) передаётся в on_ready(user_id, url).
+    """
+
+    def __init__(self, token, storage_dir='avatars', sizes=(64, 128, 256), default_size=128,
+                 api_url='https://api.telegram.org', url_prefix='/avatars', on_ready=None,
+                 workers=2, max_queue=1000, retry_after=86400, timeout=10, max_tracked=100000):
+        self.token = token
+        self.storage_dir = storage_dir
+        self.sizes = tuple(sizes)
+        self.default_size = default_size
+        self.api_url = api_url.rstrip('/')
+        self.url_prefix = url_prefix
+        self.on_ready = on_ready
+        self.workers = workers
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Когда пользователя последний раз ставили в очередь (LRU, не больше max_tracked)
+        self._attempted = OrderedDict()
+        self.max_tracked = max_tracked
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self.fetched = 0
+        self.missing = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.token)
+
+    def _session(self):
+        # Отдельная сессия на поток: keep-alive соединения к api.telegram.org переиспользуются
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _api(self, method, **params):
+        response = self._session().get(f'{self.api_url}/bot{self.token}/{method}', params=params,
+                                       timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data['result']
+
+    def download(self, user_id):
+        """Исходное фото профиля (bytes) или None, если фото нет"""
+        photos = self._api('getUserProfilePhotos', user_id=user_id, limit=1)
+        if not photos.get('total_count') or not photos.get('photos'):
+            return None
+        # Варианты отсортированы по возрастанию; берём наибольший
+        file_id = photos['photos'][0][-1]['file_id']
+        file_path = self._api('getFile', file_id=file_id)['file_path']
+        response = self._session().get(f'{self.api_url}/file/bot{self.token}/{file_path}', timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def describe_error(self, e):
+        """Текст ошибки для лога без токена бота (requests включает URL с токеном в сообщение)"""
+        if isinstance(e, requests.RequestException):
+            response = getattr(e, 'response', None)
+            status = response.status_code if response is not None else None
+            return f'{type(e).__name__} (status {status})' if status else type(e).__name__
+        message = str(e)
+        return message.replace(self.token, '***') if self.token else message
+
+    def store(self, image_bytes):
+        """Сохраняет миниатюры всех размеров и возвращает URL размера default_size"""
+        digest = hashlib.sha256(image_bytes).hexdigest()[:20]
+        os.makedirs(self.storage_dir, exist_ok=True)
+        image = None
+        for size in self.sizes:
+            path = os.path.join(self.storage_dir, f'{digest}-{size}.webp')
+            if os.path.exists(path):
+                continue
+            if image is None:
+                image = Image.open(io.BytesIO(image_bytes))
+                image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+            thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            # Пишем во временный файл и переименовываем, чтобы не отдать недописанный
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            thumb.save(tmp_path, 'WEBP', quality=80, method=4)
+            os.replace(tmp_path, path)
+        return f'{self.url_prefix}/{digest}-{self.default_size}.webp'
+
+    def fetch(self, user_id):
+        """Синхронно загружает аватарку; возвращает URL или None"""
+        image_bytes = self.download(user_id)
+        if image_bytes is None:
+            self.missing += 1
+            return None
+        url = self.store(image_bytes)
+        self.fetched += 1
+        return url
+
+    def enqueue(self, user_id):
+        """Ставит загрузку в очередь (не чаще раза в retry_after для одного пользователя)"""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            attempted = self._attempted.get(user_id)
+            if attempted is not None and now - attempted < self.retry_after:
+                return False
+            self._attempted[user_id] = now
+            self._attempted.move_to_end(user_id)
+            while len(self._attempted) > self.max_tracked:
+                self._attempted.popitem(last=False)
+        self.start()
+        try:
+            self._queue.put_nowait(user_id)
+        except queue.Full:
+            self.dropped += 1
+            with self._lock:
+                self._attempted.pop(user_id, None)
+            return False
+        return True
+
+    def start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'avatar-fetch-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            user_id = self._queue.get()
+            try:
+                url = self.fetch(user_id)
+                if url and self.on_ready is not None:
+                    self.on_ready(user_id, url)
+            except Exception as e:
+                self.failed += 1
+                log.warning('Ошибка загрузки аватарки %s: %s', user_id, self.describe_error(e))
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Ждёт обработки всей очереди"""
+        self._queue.join()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'fetched': self.fetched,
+            'missing': self.missing,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,817 @@
+"""Бенчмарки приложения.
+
+Запуск: python bench.py <сценарий> [параметры]
+Каждый сценарий работает во временной директории и не трогает рабочий users.db.
+
+Нагрузочный прогон с контролем регрессий:
+    python bench.py seed --db /tmp/users-1m.db --users 1000000
+    cp /tmp/users-1m.db /tmp/run.db && python bench.py load --db /tmp/run.db --save-baseline base.json
+    cp /tmp/users-1m.db /tmp/run.db && python bench.py load --db /tmp/run.db --baseline base.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_app(workdir):
+    """Импортирует app.py так, чтобы users.db создавался во временной директории"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    app_module.init_db()
+    return app_module
+
+
+def _seed(app_module, count):
+    with app_module.db_pool.connection() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, language_code) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((uid, f'user{uid}', 'Имя', 'Фамилия', 'ru') for uid in range(1, count + 1)),
+        )
+        conn.commit()
+
+
+def _report(name, samples):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<28} mean={statistics.mean(samples) * 1e6:8.1f}us "
+          f"p50={p50 * 1e6:8.1f}us p99={p99 * 1e6:8.1f}us")
+    return statistics.mean(samples)
+
+
+def bench_pool(args):
+    """Задержка чтения пользователя: новое соединение на запрос против пула"""
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+
+    def connect_per_call(user_id):
+        # Старый путь: sqlite3.connect + SELECT + close на каждый вызов
+        conn = sqlite3.connect('users.db')
+        try:
+            return conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        finally:
+            conn.close()
+
+    old, new = [], []
+    for i in range(args.requests):
+        user_id = i % args.users + 1
+        start = time.perf_counter()
+        connect_per_call(user_id)
+        old.append(time.perf_counter() - start)
+
+        # Пул: весь app context, включая возврат соединения в teardown
+        start = time.perf_counter()
+        with app_module.app.app_context():
+            app_module.get_user_data(user_id)
+        new.append(time.perf_counter() - start)
+
+    before = _report('connect per call', old)
+    after = _report('connection pool', new)
+    print(f"speedup: x{before / after:.1f}, opened connections: {app_module.db_pool.opened}")
+
+
+def _wal_size(path):
+    wal = path + '-wal'
+    return os.path.getsize(wal) if os.path.exists(wal) else 0
+
+
+def bench_upsert(args):
+    """Запись визитов: SELECT + INSERT OR REPLACE против UPSERT из UserRepository"""
+    os.chdir(args.workdir)
+    sys.path.insert(0, ROOT)
+    from db import ConnectionPool
+    from repository import UserRepository
+
+    # Старая схема: дублирующий idx_user_id, без row_version
+    old = sqlite3.connect('old.db')
+    old.execute('PRAGMA journal_mode=WAL')
+    old.execute('PRAGMA wal_autocheckpoint=0')
+    old.execute('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY, user_id INTEGER UNIQUE, username TEXT, first_name TEXT,
+            last_name TEXT, language_code TEXT, avatar_url TEXT, custom_username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    old.execute('CREATE INDEX idx_user_id ON users(user_id)')
+    old.execute('CREATE INDEX idx_username ON users(username)')
+
+    pool = ConnectionPool('new.db', max_size=1)
+    repo = UserRepository(pool)
+    repo.migrate()
+    with pool.connection() as conn:
+        conn.execute('PRAGMA wal_autocheckpoint=0')
+
+    def visits():
+        # Каждый пользователь заходит несколько раз, часть визитов меняет имя
+        for i in range(args.requests):
+            user_id = i % args.users + 1
+            yield user_id, f'user{user_id}_{i // (args.users * 2)}', 'Имя', 'Фамилия', 'ru'
+
+    def old_write(user_id, username, first_name, last_name, language_code):
+        row = old.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        avatar_url = row[6] if row else None
+        custom_username = row[7] if row else None
+        old.execute(
+            'INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, language_code, '
+            'avatar_url, custom_username) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, username, first_name, last_name, language_code, avatar_url, custom_username),
+        )
+        old.commit()
+
+    results = {}
+    for name, write, path in (('INSERT OR REPLACE', old_write, 'old.db'), ('UPSERT', repo.upsert_visit, 'new.db')):
+        wal_before = _wal_size(path)
+        start = time.perf_counter()
+        for visit in visits():
+            write(*visit)
+        elapsed = time.perf_counter() - start
+        conn = sqlite3.connect(path)
+        max_rowid = conn.execute('SELECT MAX(id) FROM users').fetchone()[0]
+        conn.close()
+        results[name] = (elapsed, _wal_size(path) - wal_before, max_rowid)
+        print(f"{name:<18} {args.requests / elapsed:9.0f} writes/s  WAL {(_wal_size(path) - wal_before) / 1024:9.0f} KiB  "
+              f"max rowid {max_rowid} for {args.users} users")
+    old_wal, new_wal = results['INSERT OR REPLACE'][1], results['UPSERT'][1]
+    print(f"WAL bytes per visit: {old_wal / args.requests:.0f} -> {new_wal / args.requests:.0f}")
+
+
+def _wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def _load(port, args, make_request):
+    """Нагрузка с args.concurrency keep-alive клиентов.
+
+    make_request(n, i) -> (метка, метод, путь, тело) для i-го запроса клиента n.
+    Возвращает задержки по меткам, число ответов по статусам и общее время.
+    """
+    latencies = {}
+    statuses = {}
+    lock = threading.Lock()
+    per_client = args.requests // args.concurrency
+
+    def client(n):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local, codes = {}, {}
+        for i in range(per_client):
+            label, method, path, body = make_request(n, i)
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            start = time.perf_counter()
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            local.setdefault(label, []).append(time.perf_counter() - start)
+            codes[response.status] = codes.get(response.status, 0) + 1
+        conn.close()
+        with lock:
+            for label, samples in local.items():
+                latencies.setdefault(label, []).extend(samples)
+            for status, count in codes.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - start
+
+
+def _percentile(samples, q):
+    # samples отсортированы; ближайший ранг
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def bench_serve(args):
+    """Пропускная способность и p99: сервер разработки Flask против wsgi.py (gevent)"""
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+    app_module.shutdown()
+    per_client = args.requests // args.concurrency
+
+    def make_request(n, i):
+        # 10% запросов - POST /api/username
+        user_id = (n * per_client + i) % args.users + 1
+        if i % 10 == 0:
+            return 'update', 'POST', '/api/username', json.dumps({'user_id': user_id, 'username': f'custom{i}'})
+        return 'username', 'GET', f'/api/user/{user_id}/username', None
+
+    servers = (
+        ('flask dev server', [sys.executable, os.path.join(ROOT, 'app.py')], {}),
+        ('gevent wsgi.py', [sys.executable, os.path.join(ROOT, 'wsgi.py')], {'WEB_WORKERS': str(args.workers)}),
+    )
+    for name, command, extra_env in servers:
+        env = dict(os.environ, PORT=str(args.port), **extra_env)
+        server = subprocess.Popen(command, cwd=args.workdir, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_port(args.port)
+            latencies, _, elapsed = _load(args.port, args, make_request)
+        finally:
+            server.terminate()
+            server.wait()
+        latencies = sorted(sample for samples in latencies.values() for sample in samples)
+        print(f"{name:<18} {len(latencies) / elapsed:8.0f} req/s  "
+              f"p50={_percentile(latencies, 0.5) * 1000:6.1f}ms  "
+              f"p99={_percentile(latencies, 0.99) * 1000:6.1f}ms")
+
+
+def bench_pages(args):
+    """Рендер страниц: render_template на каждый запрос против кэша страниц и 304"""
+    from jinja2 import DictLoader
+
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+    # В репозитории нет templates/: берём index.html (~59 КБ) как шаблон /glav
+    with open(os.path.join(ROOT, 'index.html'), encoding='utf-8') as f:
+        source = f.read()
+    app_module.app.jinja_env.loader.loader = DictLoader({'glav.html': source})
+    client = app_module.app.test_client()
+    page_cache = app_module.page_cache
+    paths = [f'/glav?user_id={i % args.users + 1}&lang=ru' for i in range(args.requests)]
+
+    def run(name, headers=None):
+        samples = []
+        for path in paths:
+            start = time.perf_counter()
+            client.get(path, headers=headers or {})
+            samples.append(time.perf_counter() - start)
+        return _report(name, samples)
+
+    page_cache.enabled = False
+    uncached = run('render_template')
+    page_cache.enabled = True
+    for path in paths[:args.users]:
+        client.get(path)  # прогрев
+    cached = run('page cache hit')
+    etag = client.get(paths[0]).headers['ETag']
+    paths = paths[:1] * len(paths)
+    not_modified = run('If-None-Match -> 304', {'If-None-Match': etag})
+    print(f"speedup: hit x{uncached / cached:.1f}, 304 x{uncached / not_modified:.1f}; {page_cache.stats()}")
+
+
+def bench_compress(args):
+    """Байты на страницу без сжатия, gzip и brotli; время сжатия без кэша и с кэшем"""
+    from jinja2 import DictLoader
+
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+    with open(os.path.join(ROOT, 'index.html'), encoding='utf-8') as f:
+        source = f.read()
+    app_module.app.jinja_env.loader.loader = DictLoader({'glav.html': source})
+    client = app_module.app.test_client()
+    compressor = app_module.compressor
+    path = '/glav?user_id=1&lang=ru'
+
+    for encoding in ('identity', 'gzip', 'br'):
+        response = client.get(path, headers={'Accept-Encoding': encoding})
+        print(f"{encoding:<9} {len(response.get_data()) / 1024:8.1f} KiB  "
+              f"Content-Encoding={response.headers.get('Content-Encoding', '-')}")
+
+    def run(name, clear):
+        samples = []
+        for _ in range(args.requests // 10):
+            if clear:
+                compressor._compressed.clear()
+            start = time.perf_counter()
+            client.get(path, headers={'Accept-Encoding': 'br, gzip'})
+            samples.append(time.perf_counter() - start)
+        return _report(name, samples)
+
+    cold = run('br, no cache', clear=True)
+    cached = run('br, cached', clear=False)
+    print(f"speedup x{cold / cached:.1f}; {compressor.stats()}")
+
+
+def bench_batch(args):
+    """Список из 100 пользователей: 2N запросов /username и /avatar против одного /api/users"""
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+    client = app_module.app.test_client()
+    rng = random.Random(1)
+
+    def one_by_one(ids):
+        for user_id in ids:
+            client.get(f'/api/user/{user_id}/username')
+            client.get(f'/api/user/{user_id}/avatar')
+
+    def batch(ids):
+        client.post('/api/users', json={'ids': ids})
+
+    for cached in (False, True):
+        results = {}
+        for name, fetch in (('2N single requests', one_by_one), ('/api/users batch', batch)):
+            samples = []
+            for _ in range(max(1, args.requests // 100)):
+                ids = rng.sample(range(1, args.users + 1), 100)
+                if cached:
+                    fetch(ids)
+                else:
+                    app_module.user_cache.clear()
+                start = time.perf_counter()
+                fetch(ids)
+                samples.append(time.perf_counter() - start)
+            results[name] = _report(f"{name} ({'cached' if cached else 'cold'})", samples)
+        print(f"speedup x{results['2N single requests'] / results['/api/users batch']:.1f}")
+
+
+def _rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+BENCH_BOT_TOKEN = '123456:bench-token'
+
+
+def _init_data(user_id, bot_token=BENCH_BOT_TOKEN):
+    """Подписанный initData Telegram WebApp, как его передаёт клиент Mini App"""
+    import hashlib
+    import hmac
+    from urllib.parse import urlencode as encode
+
+    params = {'auth_date': str(int(time.time())), 'user': json.dumps({'id': user_id, 'first_name': 'Bench'})}
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(params.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    params['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return encode(params)
+
+
+def _socket_client(port, user_id, connected, received):
+    """Минимальный клиент Socket.IO по WebSocket на зелёных сокетах: держит соединение и отвечает на ping"""
+    from gevent import socket as gsocket
+    from wsproto import ConnectionType, WSConnection
+    from wsproto.events import AcceptConnection, CloseConnection, Message, Request
+
+    sock = gsocket.create_connection(('127.0.0.1', port))
+    ws = WSConnection(ConnectionType.CLIENT)
+    sock.sendall(ws.send(Request(host='127.0.0.1', target='/socket.io/?EIO=4&transport=websocket')))
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        ws.receive_data(data)
+        for event in ws.events():
+            if isinstance(event, CloseConnection):
+                return
+            if isinstance(event, AcceptConnection) or not isinstance(event, Message):
+                continue
+            packet = event.data
+            if packet.startswith('0{'):
+                # Открытие engine.io -> подключение Socket.IO с подпиской на свою комнату
+                sock.sendall(ws.send(Message(data='40' + json.dumps({'init_data': _init_data(user_id)}))))
+            elif packet.startswith('40'):
+                connected(user_id)
+            elif packet == '2':
+                sock.sendall(ws.send(Message(data='3')))
+            elif packet.startswith('42'):
+                received(user_id, time.perf_counter())
+
+
+def bench_sockets(args):
+    """args.sockets простаивающих Socket.IO-соединений: память на соединение и задержка доставки user_updated"""
+    import gevent
+    from gevent import socket as gsocket
+    from gevent.event import Event
+
+    import resource
+
+    # Сервер держит два дескриптора на соединение, клиент - один
+    hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < args.sockets * 2 + 100:
+        print(f"warning: RLIMIT_NOFILE {hard} is too low for {args.sockets} sockets (need {args.sockets * 2 + 100})")
+
+    app_module = _load_app(args.workdir)
+    _seed(app_module, args.users)
+    app_module.shutdown()
+
+    # Токен нужен для проверки initData; Bot API недоступен, аватарки не загружаются
+    env = dict(os.environ, PORT=str(args.port), WEB_WORKERS='1', WEB_MAX_CONNECTIONS=str(args.sockets + 100),
+               LOG_LEVEL='WARNING', TELEGRAM_BOT_TOKEN=BENCH_BOT_TOKEN, TELEGRAM_API_URL='http://127.0.0.1:9')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'wsgi.py')], cwd=args.workdir, env=env,
+                              stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(args.port)
+        gevent.sleep(0.5)
+        rss_before = _rss(server.pid)
+
+        connected = set()
+        all_connected = Event()
+        sent, delivered = {}, {}
+
+        def on_connected(user_id):
+            connected.add(user_id)
+            if len(connected) == args.sockets:
+                all_connected.set()
+
+        def on_received(user_id, at):
+            if user_id in sent and user_id not in delivered:
+                delivered[user_id] = at - sent[user_id]
+
+        start = time.perf_counter()
+        clients = []
+        for n in range(args.sockets):
+            clients.append(gevent.spawn(_socket_client, args.port, n % args.users + 1, on_connected, on_received))
+            if n % 100 == 99:
+                gevent.sleep(0)
+        if not all_connected.wait(timeout=120):
+            print(f"only {len(connected)} of {args.sockets} sockets connected")
+        connect_time = time.perf_counter() - start
+        gevent.sleep(1)
+        rss_after = _rss(server.pid)
+        print(f"{len(connected)} sockets connected in {connect_time:.1f}s; server RSS "
+              f"{rss_before / 2 ** 20:.0f} -> {rss_after / 2 ** 20:.0f} MiB, "
+              f"{(rss_after - rss_before) / max(1, len(connected)) / 1024:.1f} KiB per connection")
+
+        def post_username(user_id):
+            body = json.dumps({'user_id': user_id, 'username': f'pushed{user_id}'}).encode()
+            sock = gsocket.create_connection(('127.0.0.1', args.port))
+            sent[user_id] = time.perf_counter()
+            sock.sendall(f'POST /api/username HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            while sock.recv(65536):
+                pass
+            sock.close()
+
+        # Изменения по одному: время от отправки POST до события у подписчика
+        targets = random.Random(1).sample(sorted(connected), min(200, len(connected)))
+        for user_id in targets:
+            post_username(user_id)
+            gevent.sleep(0.005)
+        gevent.sleep(1)
+        latencies = sorted(delivered.values())
+        if latencies:
+            print(f"delivered {len(latencies)}/{len(targets)} updates: p50={_percentile(latencies, 0.5) * 1000:.1f}ms "
+                  f"p95={_percentile(latencies, 0.95) * 1000:.1f}ms p99={_percentile(latencies, 0.99) * 1000:.1f}ms")
+        gevent.killall(clients, timeout=5)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _shard_writer(pattern, shards, users, count, seed, synchronous, results):
+    sys.path.insert(0, ROOT)
+    from sharding import ShardedUserRepository
+
+    repo = ShardedUserRepository.open(pattern, shards, max_size=1)
+    for pool in repo.pool.pools:
+        # Соединение возвращается в пул и переиспользуется вместе с настройкой
+        with pool.connection() as conn:
+            conn.execute(f'PRAGMA synchronous={synchronous}')
+    rng = random.Random(seed)
+    start = time.time()
+    for i in range(count):
+        user_id = rng.randint(1, users)
+        # Каждый визит меняет username, поэтому UPSERT действительно пишет строку
+        repo.upsert_visit(user_id, f'user{user_id}_{seed}_{i}', 'Имя', 'Фамилия', 'ru')
+    results.put((start, time.time(), repo.pool.stats()['locked_errors']))
+
+
+def bench_shards(args):
+    """Синхронные UPSERT из args.processes процессов: один файл против 2, 4, 8 шардов"""
+    import multiprocessing
+
+    sys.path.insert(0, ROOT)
+    from sharding import ShardedUserRepository
+
+    context = multiprocessing.get_context('fork')
+    per_process = args.requests // args.processes
+    baseline = None
+    for shards in (1, 2, 4, 8):
+        pattern = os.path.join(args.workdir, f's{shards}-{{shard}}.db')
+        repo = ShardedUserRepository.open(pattern, shards, max_size=1)
+        repo.migrate()
+        repo.upsert_visits({uid: (f'user{uid}', 'Имя', 'Фамилия', 'ru') for uid in range(1, args.users + 1)})
+        repo.pool.close_all()
+
+        results = context.Queue()
+        workers = [context.Process(target=_shard_writer, args=(pattern, shards, args.users, per_process, n,
+                                                                    args.synchronous, results))
+                   for n in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        finished = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = max(end for _, end, _ in finished) - min(start for start, _, _ in finished)
+        throughput = per_process * args.processes / elapsed
+        baseline = baseline or throughput
+        print(f"{shards} shard(s), {args.processes} processes, synchronous={args.synchronous}: {throughput:8.0f} writes/s  "
+              f"x{throughput / baseline:.2f}  locked errors {sum(locked for _, _, locked in finished)}")
+
+
+def bench_bulk(args):
+    """Выгрузка NDJSON/CSV под параллельной записью и загрузка с отложенными индексами и без"""
+    sys.path.insert(0, ROOT)
+    from bulk import export_chunks, import_users
+
+    if args.db:
+        source = os.path.join(args.cwd, args.db)
+    else:
+        source = os.path.join(args.workdir, 'source.db')
+        _seed_db(source, args.users)
+    conn = sqlite3.connect(source)
+    count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    user_ids = [row[0] for row in conn.execute('SELECT user_id FROM users WHERE id % 1000 = 0')]
+    conn.close()
+
+    for fmt in ('ndjson', 'csv'):
+        path = os.path.join(args.workdir, f'users.{fmt}')
+        stop = threading.Event()
+        commits, locked = [], [0]
+
+        def write():
+            # Приложение пишет, пока идёт выгрузка: коммиты не должны ждать читателя
+            writer = sqlite3.connect(source, timeout=5)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    with writer:
+                        writer.execute('UPDATE users SET row_version = row_version + 1 WHERE user_id = ?',
+                                       (random.choice(user_ids),))
+                    commits.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    locked[0] += 1
+                time.sleep(0.001)
+            writer.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        start = time.perf_counter()
+        with open(path, 'wb') as out:
+            for chunk in export_chunks(fmt, source):
+                out.write(chunk)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        size = os.path.getsize(path)
+        commits.sort()
+        print(f"export {fmt:6}: {count} rows in {elapsed:6.1f}s  {count / elapsed:9.0f} rows/s  "
+              f"{size / elapsed / 2 ** 20:6.1f} MiB/s  {size / 2 ** 20:6.0f} MiB  |  concurrent commits "
+              f"{len(commits)}, p50 {_percentile(commits, 0.5) * 1000:.2f} ms, max {max(commits) * 1000:.1f} ms, "
+              f"locked {locked[0]}")
+
+    for defer_indexes in (True, False):
+        target = os.path.join(args.workdir, 'imported.db')
+        start = time.perf_counter()
+        with open(os.path.join(args.workdir, 'users.ndjson'), encoding='utf-8') as f:
+            loaded = import_users(target, f, 'ndjson', defer_indexes=defer_indexes)
+        elapsed = time.perf_counter() - start
+        print(f"import ndjson, indexes {'deferred' if defer_indexes else 'kept    '}: {loaded} rows in "
+              f"{elapsed:6.1f}s  {loaded / elapsed:9.0f} rows/s")
+        os.remove(target)
+
+
+FIRST_NAMES = ('Александр', 'Мария', 'Иван', 'Анна', 'Дмитрий', 'Елена', 'Сергей', 'Ольга', 'John', 'Emma',
+               'Ali', 'Wei')
+LAST_NAMES = ('Иванов', 'Смирнова', 'Кузнецов', 'Попова', 'Smith', 'Kim', '', '', '')
+# Доли языков интерфейса Telegram у аудитории бота, в процентах
+LANGUAGES = (('ru', 60), ('en', 25), ('uk', 8), ('kk', 4), ('de', 3))
+PAGE_TEMPLATES = ('index.html', 'user.html', 'prof.html', 'glav.html', 'settings.html', 'info.html')
+DEFAULT_MIX = 'index=25,prof=20,glav=20,username=30,update=5'
+
+
+def _synthetic_users(count, seed=42):
+    """Пользователи Telegram: возрастающие id с пропусками, у ~30% нет username, у ~5% свой"""
+    rng = random.Random(seed)
+    languages = [code for code, weight in LANGUAGES for _ in range(weight)]
+    user_id = 100_000_000
+    for n in range(count):
+        user_id += rng.randint(1, 600)
+        username = f'{rng.choice(FIRST_NAMES).lower()}_{n}' if rng.random() < 0.7 else None
+        custom_username = f'custom_{n}' if rng.random() < 0.05 else None
+        yield (user_id, username, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(languages),
+               custom_username)
+
+
+def _seed_db(path, count, batch=100_000):
+    sys.path.insert(0, ROOT)
+    from db import ConnectionPool
+    from repository import UserRepository
+
+    pool = ConnectionPool(path, max_size=1)
+    UserRepository(pool).migrate()
+    users = _synthetic_users(count)
+    start = time.perf_counter()
+    with pool.connection() as conn:
+        # Данные генерируются заново при сбое, поэтому fsync не нужен
+        conn.execute('PRAGMA synchronous=OFF')
+        inserted = 0
+        while inserted < count:
+            rows = list(itertools.islice(users, batch))
+            conn.executemany(
+                'INSERT INTO users (user_id, username, first_name, last_name, language_code, custom_username) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+            inserted += len(rows)
+            print(f"\r{inserted}/{count} users", end='', file=sys.stderr)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    pool.close_all()
+    elapsed = time.perf_counter() - start
+    print(f"\nseeded {count} users in {elapsed:.1f}s ({count / elapsed:.0f} rows/s), "
+          f"{os.path.getsize(path) / 2 ** 20:.0f} MiB", file=sys.stderr)
+
+
+def bench_seed(args):
+    """Создаёт args.db с args.users синтетическими пользователями (100k-10M)"""
+    path = os.path.join(args.cwd, args.db)
+    if os.path.exists(path):
+        sys.exit(f'{path} already exists')
+    _seed_db(path, args.users)
+
+
+def _sample_users(path, limit=50_000):
+    # Равномерная выборка по rowid без ORDER BY random() на миллионах строк
+    conn = sqlite3.connect(path)
+    try:
+        total = conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0
+        step = max(1, total // limit)
+        return conn.execute(
+            'SELECT user_id, username, first_name, last_name, language_code FROM users WHERE id % ? = 0 LIMIT ?',
+            (step, limit)).fetchall()
+    finally:
+        conn.close()
+
+
+def _parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        weights[route.strip()] = int(weight)
+    unknown = set(weights) - {'index', 'prof', 'glav', 'username', 'update'}
+    if unknown:
+        sys.exit(f'unknown routes in --mix: {", ".join(sorted(unknown))}')
+    return [route for route, weight in weights.items() for _ in range(weight)]
+
+
+def _summarize(latencies, statuses, elapsed):
+    total = sum(len(samples) for samples in latencies.values())
+    result = {'requests': total, 'throughput': total / elapsed, 'statuses': statuses, 'routes': {}}
+    for label, samples in sorted(latencies.items()) + [('all', [s for v in latencies.values() for s in v])]:
+        samples = sorted(samples)
+        result['routes'][label] = {
+            'count': len(samples),
+            'p50': _percentile(samples, 0.5),
+            'p95': _percentile(samples, 0.95),
+            'p99': _percentile(samples, 0.99),
+        }
+    return result
+
+
+def _check_regression(result, baseline, threshold):
+    """Сравнивает с базовым прогоном; возвращает список регрессий больше threshold"""
+    failures = []
+    if result['throughput'] < baseline['throughput'] * (1 - threshold):
+        failures.append(f"throughput {baseline['throughput']:.0f} -> {result['throughput']:.0f} req/s")
+    for label, stats in result['routes'].items():
+        base = baseline['routes'].get(label)
+        if base is None:
+            continue
+        for key in ('p95', 'p99'):
+            if stats[key] > base[key] * (1 + threshold):
+                failures.append(f"{label} {key} {base[key] * 1000:.1f} -> {stats[key] * 1000:.1f} ms")
+    return failures
+
+
+def bench_load(args):
+    """Смесь запросов /, /prof, /glav, /api/user/<id>/username и POST /api/username к wsgi.py.
+
+    Без --db база из --users пользователей создаётся во временной директории.
+    С --db нагрузка идёт на указанную базу (запросы её изменяют - используйте копию).
+    80% запросов приходится на 20% пользователей.
+    """
+    if args.db:
+        db_path = os.path.abspath(os.path.join(args.cwd, args.db))
+    else:
+        db_path = os.path.join(args.workdir, 'users.db')
+        _seed_db(db_path, args.users)
+    # В репозитории нет templates/: все страницы рендерятся из index.html
+    templates = os.path.join(args.workdir, 'templates')
+    os.makedirs(templates, exist_ok=True)
+    for name in PAGE_TEMPLATES:
+        shutil.copy(os.path.join(ROOT, 'index.html'), os.path.join(templates, name))
+
+    users = _sample_users(db_path)
+    hot = users[:max(1, len(users) // 5)]
+    routes = _parse_mix(args.mix)
+
+    def make_request(n, i):
+        rng = random.Random(n * 1_000_003 + i)
+        user_id, username, first_name, last_name, lang = rng.choice(hot if rng.random() < 0.8 else users)
+        route = rng.choice(routes)
+        if route == 'index':
+            query = urlencode({'user_id': user_id, 'username': username or '', 'first_name': first_name,
+                               'last_name': last_name, 'lang': lang})
+            return route, 'GET', f'/?{query}', None
+        if route in ('prof', 'glav'):
+            return route, 'GET', f'/{route}?user_id={user_id}&lang={lang}', None
+        if route == 'username':
+            return route, 'GET', f'/api/user/{user_id}/username', None
+        return route, 'POST', '/api/username', json.dumps({'user_id': user_id, 'username': f'custom_{n}_{i}'})
+
+    env = dict(os.environ, PORT=str(args.port), WEB_WORKERS=str(args.workers), DB_PATH=db_path,
+               TEMPLATE_DIR=templates, LOG_LEVEL='WARNING')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'wsgi.py')], cwd=args.workdir, env=env,
+                              stdout=subprocess.DEVNULL)
+    try:
+        _wait_for_port(args.port)
+        latencies, statuses, elapsed = _load(args.port, args, make_request)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = _summarize(latencies, statuses, elapsed)
+    result['config'] = {'users': len(users), 'mix': args.mix, 'concurrency': args.concurrency,
+                        'workers': args.workers, 'requests': args.requests}
+    print(f"{result['throughput']:.0f} req/s, statuses {statuses}")
+    for label, stats in result['routes'].items():
+        print(f"{label:<10} {stats['count']:7}  p50={stats['p50'] * 1000:7.1f}ms  "
+              f"p95={stats['p95'] * 1000:7.1f}ms  p99={stats['p99'] * 1000:7.1f}ms")
+
+    if args.save_baseline:
+        with open(os.path.join(args.cwd, args.save_baseline), 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(os.path.join(args.cwd, args.baseline)) as f:
+            baseline = json.load(f)
+        failures = _check_regression(result, baseline, args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"no regressions over {args.max_regression:.0%} against {args.baseline}")
+
+
+SCENARIOS = {
+    'pool': bench_pool,
+    'upsert': bench_upsert,
+    'serve': bench_serve,
+    'pages': bench_pages,
+    'compress': bench_compress,
+    'batch': bench_batch,
+    'seed': bench_seed,
+    'shards': bench_shards,
+    'bulk': bench_bulk,
+    'sockets': bench_sockets,
+    'load': bench_load,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--sockets', type=int, default=10000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--synchronous', default='NORMAL', choices=('OFF', 'NORMAL', 'FULL'),
+                        help='shards: PRAGMA synchronous писателей (FULL - fsync на каждый коммит)')
+    parser.add_argument('--db', help='seed: создаваемая база; load, bulk: готовая база вместо временной')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='load: веса маршрутов')
+    parser.add_argument('--save-baseline', help='load: сохранить результат в JSON')
+    parser.add_argument('--baseline', help='load: сравнить с сохранённым результатом')
+    parser.add_argument('--max-regression', type=float, default=0.10,
+                        help='load: допустимое ухудшение throughput/p95/p99 (доля)')
+    args = parser.parse_args()
+    if args.scenario == 'seed' and not args.db:
+        parser.error('seed requires --db')
+    args.cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        SCENARIOS[args.scenario](args)
+
+
+if __name__ == '__main__':
+    main()
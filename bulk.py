@@ -0,0 +1,276 @@
+"""Потоковая выгрузка и массовая загрузка таблицы users.
+
+Выгрузка читает через отдельное соединение только для чтения в одной
+транзакции: в WAL это согласованный снимок, писатели приложения не ждут.
+Страницы берутся по ключу (WHERE user_id > последний), без OFFSET, поэтому
+каждая страница стоит одинаково и на миллионах строк. Пока выгрузка идёт,
+контрольная точка не может укоротить WAL - файл -wal временно растёт.
+
+    python bulk.py export --db users.db --format csv --created-after 2024-01-01 > users.csv
+    python bulk.py import --db new.db users.ndjson
+
+Загрузка рассчитана на окно обслуживания: вторичные индексы удаляются на
+время загрузки и строятся заново в конце, строки пишутся транзакциями по
+batch штук без fsync. Формат определяется по расширению (.csv, иначе NDJSON).
+В CSV пустая строка и NULL неразличимы: пустые поля загружаются как NULL,
+поэтому для резервных копий нужен NDJSON - он переносит строки без потерь.
+"""
+import argparse
+import csv
+import heapq
+import io
+import itertools
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+EXPORT_COLUMNS = (
+    'user_id', 'username', 'first_name', 'last_name', 'language_code',
+    'avatar_url', 'custom_username', 'row_version', 'created_at',
+)
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+PAGE_SIZE = 5000
+# Что выбирает страница: колонки для CSV, для NDJSON - user_id (ключ страниц) и готовая строка JSON.
+# json_object собирает JSON внутри SQLite, это в 2-3 раза быстрее json.dumps на каждую строку
+_SELECTS = {
+    'csv': ', '.join(EXPORT_COLUMNS),
+    'ndjson': 'user_id, json_object({})'.format(', '.join(f"'{column}', {column}" for column in EXPORT_COLUMNS)),
+}
+
+# Повторная загрузка той же выгрузки перезаписывает строки, а не дублирует их.
+# Поля NOT NULL без значения в выгрузке получают значения по умолчанию
+_UPSERT = f'''
+    INSERT INTO users ({', '.join(EXPORT_COLUMNS)})
+    VALUES ({{}}, COALESCE({{}}, 0), COALESCE({{}}, CURRENT_TIMESTAMP))
+    ON CONFLICT(user_id) DO UPDATE SET
+        {', '.join(f'{column} = excluded.{column}' for column in EXPORT_COLUMNS[1:])}
+'''
+# CSV разбирает модуль csv; строку NDJSON целиком разбирает SQLite (json_extract),
+# без json.loads и словаря на каждую строку загрузка почти вдвое быстрее
+def _json_fields(columns):
+    return ', '.join(f"json_extract(?1, '$.{column}')" for column in columns)
+
+
+_IMPORTS = {
+    'csv': _UPSERT.format(', '.join('?' * (len(EXPORT_COLUMNS) - 2)), '?', '?'),
+    'ndjson': _UPSERT.format(_json_fields(EXPORT_COLUMNS[:-2]), _json_fields(['row_version']),
+                             _json_fields(['created_at'])),
+}
+
+
+def parse_timestamp(value):
+    """'2024-01-31' или '2024-01-31T12:00:00' в формат created_at ('2024-01-31 12:00:00')"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _page_query(select, created_after, created_before):
+    query = f"SELECT {select} FROM users WHERE user_id > ?"
+    params = []
+    if created_after:
+        query += ' AND created_at >= ?'
+        params.append(created_after)
+    if created_before:
+        query += ' AND created_at < ?'
+        params.append(created_before)
+    return f'{query} ORDER BY user_id LIMIT ?', params
+
+
+def _iter_file(path, select, after, created_after, created_before, page_size, run):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+    try:
+        query, params = _page_query(select, created_after, created_before)
+        # Все страницы - из одной транзакции чтения, то есть из одного снимка БД
+        conn.execute('BEGIN')
+        while True:
+            rows = run(lambda: conn.execute(query, (after, *params, page_size)).fetchall())
+            if not rows:
+                return
+            yield rows
+            after = rows[-1][0]
+    finally:
+        conn.close()
+
+
+def iter_users(paths, select=_SELECTS['csv'], after=0, created_after=None, created_before=None, limit=None,
+               page_size=PAGE_SIZE, run=None):
+    """Страницы строк по возрастанию user_id (первая колонка select - user_id).
+
+    paths - файл БД или список шардов (строки сливаются по user_id).
+    run(fn) выполняет запрос страницы (под gevent - pool.run_blocking).
+    """
+    if after < 0 or (limit is not None and limit < 0):
+        raise ValueError(f'after и limit не могут быть отрицательными: after={after}, limit={limit}')
+    run = run or (lambda fn: fn())
+    if isinstance(paths, str):
+        paths = [paths]
+    sources = [_iter_file(path, select, after, created_after, created_before, page_size, run) for path in paths]
+    if len(sources) == 1:
+        pages = sources[0]
+    else:
+        # Шарды уже отсортированы по user_id: слияние без общей сортировки
+        pages = _batched(heapq.merge(*((row for rows in source for row in rows) for source in sources)), page_size)
+    remaining = limit
+    try:
+        for rows in pages:
+            if remaining is not None:
+                rows = rows[:remaining]
+                remaining -= len(rows)
+            if rows:
+                yield rows
+            if remaining == 0:
+                break
+    finally:
+        # Клиент мог оборвать загрузку: закрываем соединения сразу
+        for source in sources:
+            source.close()
+
+
+def _batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ndjson_chunks(pages):
+    for rows in pages:
+        yield ''.join(f'{row[1]}\n' for row in rows).encode()
+
+
+def _csv_chunks(pages):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in pages:
+        writer.writerows(rows)
+        yield out.getvalue().encode()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
+
+
+def export_chunks(fmt, paths, **options):
+    """Выгрузка в формате fmt порциями bytes (одна на страницу, у CSV сначала заголовок).
+
+    options - фильтры и параметры iter_users: after, created_after, created_before, limit, run.
+    """
+    pages = iter_users(paths, _SELECTS[fmt], **options)
+    return _ndjson_chunks(pages) if fmt == 'ndjson' else _csv_chunks(pages)
+
+
+def _read_rows(stream, fmt):
+    # Параметры _IMPORTS[fmt]: колонки CSV или строка NDJSON целиком
+    if fmt == 'csv':
+        for record in csv.DictReader(stream):
+            yield tuple(record.get(column) or None for column in EXPORT_COLUMNS)
+    else:
+        for line in stream:
+            if line.strip():
+                yield (line,)
+
+
+def import_users(path, stream, fmt='ndjson', batch=100_000, defer_indexes=True, progress=None):
+    """Загружает выгрузку из текстового потока в users базы path; возвращает число строк"""
+    from db import ConnectionPool
+    from repository import UserRepository
+
+    pool = ConnectionPool(path, max_size=1)
+    UserRepository(pool).migrate()
+    conn = pool.acquire()
+    indexes = []
+    try:
+        # Загрузку можно повторить с начала, fsync на каждую транзакцию не нужен
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA cache_size=-262144')
+        if defer_indexes:
+            # UNIQUE(user_id) остаётся: по нему работает ON CONFLICT
+            indexes = conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'users' "
+                "AND sql IS NOT NULL").fetchall()
+            for name, _ in indexes:
+                conn.execute(f'DROP INDEX {name}')
+        loaded = 0
+        rows = _read_rows(stream, fmt)
+        while True:
+            chunk = list(itertools.islice(rows, batch))
+            if not chunk:
+                break
+            with conn:
+                conn.executemany(_IMPORTS[fmt], chunk)
+            loaded += len(chunk)
+            if progress is not None:
+                progress(loaded)
+    finally:
+        try:
+            # Индексы возвращаются и после ошибки: миграции их не восстановят,
+            # user_version уже актуален
+            for _, sql in indexes:
+                conn.execute(sql)
+            conn.execute('PRAGMA optimize')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            pool.release()
+            pool.close_all()
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка и загрузка таблицы users')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='выгрузка в stdout или файл')
+    export_parser.add_argument('--db', nargs='+', default=['users.db'], help='файл БД или все файлы шардов')
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    export_parser.add_argument('--created-after')
+    export_parser.add_argument('--created-before')
+    export_parser.add_argument('--after', type=int, default=0, help='продолжить после этого user_id')
+    export_parser.add_argument('--output', '-o')
+    import_parser = commands.add_parser('import', help='массовая загрузка выгрузки')
+    import_parser.add_argument('--db', default='users.db')
+    import_parser.add_argument('--format', choices=EXPORT_FORMATS)
+    import_parser.add_argument('--batch', type=int, default=100_000)
+    import_parser.add_argument('--keep-indexes', action='store_true', help='не удалять индексы на время загрузки')
+    import_parser.add_argument('source', help="файл выгрузки или '-' для stdin")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        chunks = export_chunks(args.format, args.db, after=args.after,
+                               created_after=parse_timestamp(args.created_after),
+                               created_before=parse_timestamp(args.created_before))
+        out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        written = 0
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if args.output:
+                out.close()
+        print(f"exported {written / 2 ** 20:.1f} MiB in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        return
+
+    fmt = args.format or ('csv' if args.source.endswith('.csv') else 'ndjson')
+    stream = sys.stdin if args.source == '-' else open(args.source, encoding='utf-8', newline='')
+    try:
+        loaded = import_users(args.db, stream, fmt, batch=args.batch,
+                              defer_indexes=not args.keep_indexes,
+                              progress=lambda n: print(f"\r{n} users", end='', file=sys.stderr))
+    finally:
+        stream.close()
+    elapsed = time.perf_counter() - start
+    print(f"\nimported {loaded} users in {elapsed:.1f}s ({loaded / elapsed:.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
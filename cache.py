@@ -0,0 +1,501 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:  # Без redis TwoLevelUserCache не используется
+    class WatchError(Exception):
+        pass
+
+log = logging.getLogger(__name__)
+
+
+class UserCache:
+    """Потокобезопасный LRU-кэш пользователей с TTL.
+
+    Ключ всегда приводится к int, чтобы str(user_id) и user_id
+    указывали на одну и ту же запись.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, clock=time.monotonic, max_tombstones=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # Номер последней инвалидации. Загрузчик запоминает его до чтения из БД,
+        # а set() отбрасывает значение, только если инвалидирован именно этот ключ:
+        # запись других пользователей не мешает кэшировать промахи
+        self.generation = 0
+        # Когда ключ инвалидирован последний раз (ограниченный LRU); вытесненная
+        # запись поднимает _floor - для более старых загрузок ответ "устарело"
+        self._tombstones = OrderedDict()
+        self.max_tombstones = max_tombstones
+        self._floor = 0
+        self._listeners = []
+
+    def get(self, user_id):
+        """Возвращает данные пользователя или None, если их нет или они устарели"""
+        with self._lock:
+            return self._get(int(user_id), self._clock())
+
+    def get_many(self, user_ids):
+        """Словарь {user_id: данные} для найденных в кэше; одна блокировка на весь набор"""
+        found = {}
+        with self._lock:
+            now = self._clock()
+            for user_id in user_ids:
+                value = self._get(int(user_id), now)
+                if value is not None:
+                    found[int(user_id)] = value
+        return found
+
+    def _get(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if now >= expires_at:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _is_stale(self, key, generation):
+        return generation < self._floor or self._tombstones.get(key, 0) > generation
+
+    def is_stale(self, user_id, generation):
+        """Был ли ключ инвалидирован после момента generation"""
+        with self._lock:
+            return self._is_stale(int(user_id), generation)
+
+    def set(self, user_id, value, generation=None, ttl=None):
+        """Кладёт значение в кэш; если ключ инвалидирован после generation, запись пропускается"""
+        key = int(user_id)
+        with self._lock:
+            if generation is not None and self._is_stale(key, generation):
+                return
+            self._data[key] = (value, self._clock() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        """Удаляет запись пользователя; вызывается каждым путём записи в БД"""
+        key = int(user_id)
+        with self._lock:
+            self.generation += 1
+            self._tombstones[key] = self.generation
+            self._tombstones.move_to_end(key)
+            while len(self._tombstones) > self.max_tombstones:
+                self._floor = self._tombstones.popitem(last=False)[1]
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+        for listener in self._listeners:
+            listener(user_id)
+
+    def add_invalidation_listener(self, listener):
+        """listener(user_id) вызывается после каждой инвалидации (в т.ч. пришедшей из Redis)"""
+        self._listeners.append(listener)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            # Все загрузки, начатые до очистки, устарели
+            self._floor = self.generation
+            self._tombstones.clear()
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, user_id):
+        return int(user_id) in self._data
+
+    def items(self):
+        """Живые записи [(user_id, данные, оставшийся TTL)] от давно использованных к недавним"""
+        with self._lock:
+            now = self._clock()
+            return [(key, value, expires_at - now) for key, (value, expires_at) in self._data.items()
+                    if expires_at > now]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+class _InflightLoad:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class UserLookup:
+    """Чтение пользователя через кэш (read-through).
+
+    При промахе пользователь загружается из БД; параллельные промахи
+    по одному user_id ждут единственный запрос (single-flight).
+    """
+
+    def __init__(self, cache, loader, many_loader=None):
+        self.cache = cache
+        self.loader = loader
+        # many_loader(ids) -> {user_id: данные}: промахи get_many одним запросом
+        self.many_loader = many_loader
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.coalesced = 0
+
+    def get(self, user_id):
+        key = int(user_id)
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            load = self._inflight.get(key)
+            leader = load is None
+            if leader:
+                load = self._inflight[key] = _InflightLoad()
+                generation = self.cache.generation
+
+        if not leader:
+            self.coalesced += 1
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return load.value
+
+        try:
+            self.loads += 1
+            load.value = self.loader(key)
+            if load.value is not None:
+                self.cache.set(key, load.value, generation=generation)
+        except Exception as e:
+            load.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            load.done.set()
+        return load.value
+
+    def get_many(self, user_ids):
+        """Словарь {user_id: данные} для существующих пользователей.
+
+        Попадания берутся из кэша, промахи загружаются одним вызовом
+        many_loader (без single-flight: пакеты редко совпадают целиком).
+        """
+        keys = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        found = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if not missing:
+            return found
+        if self.many_loader is None:
+            for key in missing:
+                value = self.get(key)
+                if value is not None:
+                    found[key] = value
+            return found
+        generation = self.cache.generation
+        self.loads += 1
+        loaded = self.many_loader(missing)
+        for key, value in loaded.items():
+            self.cache.set(key, value, generation=generation)
+        found.update(loaded)
+        return found
+
+    def stats(self):
+        return {'loads': self.loads, 'coalesced': self.coalesced, 'inflight': len(self._inflight)}
+
+
+_MISSING = object()
+
+
+class TwoLevelUserCache:
+    """Двухуровневый кэш: UserCache в процессе (L1) и Redis (L2).
+
+    Каждая инвалидация удаляет ключ в Redis, увеличивает счётчик версии
+    ключа ({prefix}v:{id}) и рассылается через pub/sub, чтобы остальные
+    процессы сбросили свой L1. Если Redis недоступен, кэш работает только
+    на L1 и повторяет попытку через retry_interval; инвалидации за время
+    сбоя копятся и повторяются после восстановления (не больше max_pending,
+    дальше - очистка всего L2).
+
+    Загрузка после промаха попадает в L2, только если версия ключа не
+    изменилась с момента промаха (WATCH/MULTI): иначе загрузка, начатая до
+    инвалидации в другом процессе, вернула бы в Redis старые данные.
+    Интерфейс совпадает с UserCache.
+    """
+
+    def __init__(self, l1, client, ttl=300, prefix='user:', channel='user-cache-invalidate',
+                 retry_interval=5.0, max_pending=10000, clock=time.monotonic):
+        self.l1 = l1
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.version_prefix = f'{prefix}v:'
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.max_pending = max_pending
+        self._clock = clock
+        self._down_until = 0.0
+        self._instance = uuid.uuid4().hex
+        self._listener = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        # Инвалидации, не дошедшие до Redis; _pending_all - их было больше max_pending
+        self._pending = set()
+        self._pending_all = False
+        # Версия ключа в L2 при последнем промахе: {user_id: bytes или None}
+        self._observed = OrderedDict()
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+        self.remote_invalidations = 0
+
+    @property
+    def generation(self):
+        return self.l1.generation
+
+    @property
+    def available(self):
+        return self._clock() >= self._down_until
+
+    def _failed(self, e):
+        self.l2_errors += 1
+        self._down_until = self._clock() + self.retry_interval
+        log.warning('Redis недоступен, работаем без L2: %s', e)
+
+    def _ready(self):
+        """Redis доступен и получил все инвалидации, накопленные за время сбоя"""
+        if not self.available:
+            return False
+        if self._pending or self._pending_all:
+            return self._replay_pending()
+        return True
+
+    def _defer(self, user_id):
+        with self._lock:
+            if self._pending_all:
+                return
+            self._pending.add(int(user_id))
+            if len(self._pending) > self.max_pending:
+                self._pending.clear()
+                self._pending_all = True
+
+    def _replay_pending(self):
+        with self._lock:
+            keys, self._pending = self._pending, set()
+            flush_all, self._pending_all = self._pending_all, False
+        try:
+            if flush_all:
+                # Пропущенных ключей слишком много: сбрасываем L2 целиком, кроме версий
+                pipe = self.client.pipeline(transaction=False)
+                for key in self.client.scan_iter(match=f'{self.prefix}*', count=1000):
+                    name = key.decode() if isinstance(key, bytes) else key
+                    if not name.startswith(self.version_prefix):
+                        pipe.delete(key)
+                pipe.publish(self.channel, f'{self._instance}:*')
+                pipe.execute()
+            else:
+                pipe = self.client.pipeline(transaction=False)
+                for user_id in keys:
+                    self._queue_invalidation(pipe, user_id)
+                pipe.execute()
+        except Exception as e:
+            with self._lock:
+                self._pending |= keys
+                self._pending_all = self._pending_all or flush_all
+            self._failed(e)
+            return False
+        log.info('Redis снова доступен: повторено инвалидаций L2: %s', 'все' if flush_all else len(keys))
+        return True
+
+    def _queue_invalidation(self, pipe, user_id):
+        pipe.delete(f'{self.prefix}{user_id}')
+        pipe.incr(f'{self.version_prefix}{user_id}')
+        pipe.expire(f'{self.version_prefix}{user_id}', self.ttl)
+        pipe.publish(self.channel, f'{self._instance}:{user_id}')
+
+    def _observe(self, user_id, version):
+        with self._lock:
+            # Сохраняем первую версию: загрузку начал самый ранний промах
+            self._observed.setdefault(user_id, version)
+            self._observed.move_to_end(user_id)
+            while len(self._observed) > self.l1.max_entries:
+                self._observed.popitem(last=False)
+
+    def get(self, user_id):
+        value = self.l1.get(user_id)
+        if value is not None or not self._ready():
+            return value
+        user_id = int(user_id)
+        try:
+            raw, version = self.client.mget([f'{self.prefix}{user_id}', f'{self.version_prefix}{user_id}'])
+        except Exception as e:
+            self._failed(e)
+            return None
+        if raw is None:
+            self.l2_misses += 1
+            self._observe(user_id, version)
+            return None
+        self.l2_hits += 1
+        value = json.loads(raw)
+        self.l1.set(user_id, value)
+        return value
+
+    def get_many(self, user_ids):
+        found = self.l1.get_many(user_ids)
+        missing = [int(user_id) for user_id in user_ids if int(user_id) not in found]
+        if not missing or not self._ready():
+            return found
+        try:
+            # Один MGET вместо запроса на каждого пользователя: значения, затем версии
+            raws = self.client.mget([f'{self.prefix}{user_id}' for user_id in missing] +
+                                    [f'{self.version_prefix}{user_id}' for user_id in missing])
+        except Exception as e:
+            self._failed(e)
+            return found
+        for user_id, raw, version in zip(missing, raws, raws[len(missing):]):
+            if raw is None:
+                self.l2_misses += 1
+                self._observe(user_id, version)
+                continue
+            self.l2_hits += 1
+            found[user_id] = json.loads(raw)
+            self.l1.set(user_id, found[user_id])
+        return found
+
+    def set(self, user_id, value, generation=None):
+        if generation is not None and self.l1.is_stale(user_id, generation):
+            return
+        self.l1.set(user_id, value, generation=generation)
+        user_id = int(user_id)
+        if generation is not None:
+            with self._lock:
+                version = self._observed.pop(user_id, _MISSING)
+            if version is _MISSING:
+                # Промах был без L2 (сбой или вытесненная запись): версию не сверить
+                return
+        if not self._ready():
+            return
+        try:
+            if generation is None:
+                # Свежие данные из пути записи
+                self.client.setex(f'{self.prefix}{user_id}', self.ttl, json.dumps(value))
+            else:
+                self._set_if_unchanged(user_id, value, version)
+        except Exception as e:
+            self._failed(e)
+
+    def _set_if_unchanged(self, user_id, value, version):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(f'{self.version_prefix}{user_id}')
+                if pipe.get(f'{self.version_prefix}{user_id}') != version:
+                    # Другой процесс инвалидировал ключ после промаха
+                    return
+                pipe.multi()
+                pipe.setex(f'{self.prefix}{user_id}', self.ttl, json.dumps(value))
+                pipe.execute()
+            except WatchError:
+                pass
+
+    def invalidate(self, user_id):
+        self.l1.invalidate(user_id)
+        if not self._ready():
+            self._defer(user_id)
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            self._queue_invalidation(pipe, int(user_id))
+            pipe.execute()
+        except Exception as e:
+            self._defer(user_id)
+            self._failed(e)
+
+    def add_invalidation_listener(self, listener):
+        self.l1.add_invalidation_listener(listener)
+
+    def clear(self):
+        # Только локальный уровень: общий L2 очищается истечением TTL
+        self.l1.clear()
+
+    def __len__(self):
+        return len(self.l1)
+
+    def start_listener(self):
+        """Запускает поток, применяющий инвалидации от других процессов"""
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name='user-cache-pubsub', daemon=True)
+            self._listener.start()
+
+    def stop_listener(self):
+        self._stopping.set()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while not self._stopping.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._on_message(message['data'])
+            except Exception as e:
+                self._failed(e)
+                # После переподключения L1 мог пропустить инвалидации
+                self.l1.clear()
+                self._stopping.wait(self.retry_interval)
+
+    def _on_message(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        instance, _, user_id = data.partition(':')
+        if instance == self._instance:
+            return
+        self.remote_invalidations += 1
+        if user_id == '*':
+            self.l1.clear()
+        else:
+            self.l1.invalidate(user_id)
+
+    def stats(self):
+        stats = self.l1.stats()
+        stats.update({
+            'l2_available': self.available,
+            'l2_pending_invalidations': -1 if self._pending_all else len(self._pending),
+            'l2_hits': self.l2_hits,
+            'l2_misses': self.l2_misses,
+            'l2_errors': self.l2_errors,
+            'remote_invalidations': self.remote_invalidations,
+        })
+        return stats
@@ -0,0 +1,96 @@
+"""Сжатие ответов (brotli/gzip) и минификация HTML"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from flask_compress import Compress
+
+_RAW_BLOCK_RE = re.compile(r'(<(script|style|pre|textarea)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+_HTML_COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_BLANK_LINES_RE = re.compile(r'\s*\n\s*')
+_SPACES_RE = re.compile(r'[ \t]{2,}')
+
+
+def minify_html(html):
+    """Удаляет комментарии и лишние пробелы; содержимое <script>, <pre>, <textarea> не меняется"""
+    parts = _RAW_BLOCK_RE.split(html)
+    out = []
+    # split с двумя группами: [текст, блок, имя тега, текст, блок, имя тега, ...]
+    for i in range(0, len(parts), 3):
+        text = _HTML_COMMENT_RE.sub('', parts[i])
+        text = _SPACES_RE.sub(' ', _BLANK_LINES_RE.sub('\n', text))
+        out.append(text)
+        if i + 1 < len(parts):
+            block, tag = parts[i + 1], parts[i + 2].lower()
+            if tag == 'style':
+                # В CSS перевод строки с отступом никогда не значим вне строковых литералов
+                block = _BLANK_LINES_RE.sub('\n', _CSS_COMMENT_RE.sub('', block))
+            out.append(block)
+    return ''.join(out).strip()
+
+
+class _Body:
+    # Flask-Compress читает тело через response.get_data()
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+
+class Compressor(Compress):
+    """Flask-Compress с кэшем сжатых тел и минификацией HTML.
+
+    Ключ кэша - хэш исходного тела и алгоритм, поэтому одинаковые
+    страницы и JSON сжимаются один раз, независимо от маршрута.
+    """
+
+    def __init__(self, app=None, cache_entries=512, minify=True):
+        self.cache_entries = cache_entries
+        self.minify = minify
+        self._compressed = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ALGORITHM', ['br', 'gzip'])
+        app.config.setdefault('COMPRESS_BR_LEVEL', 6)
+        super().init_app(app)
+
+    def compress(self, app, response, algorithm):
+        body = response.get_data()
+        key = (hashlib.sha1(body).digest(), algorithm)
+        with self._lock:
+            compressed = self._compressed.get(key)
+            if compressed is not None:
+                self._compressed.move_to_end(key)
+                self.hits += 1
+        if compressed is None:
+            self.misses += 1
+            data = body
+            if self.minify and response.mimetype == 'text/html':
+                charset = response.mimetype_params.get('charset', 'utf-8')
+                data = minify_html(body.decode(charset)).encode(charset)
+            compressed = super().compress(app, _Body(data), algorithm)
+            with self._lock:
+                self._compressed[key] = compressed
+                while len(self._compressed) > self.cache_entries:
+                    self._compressed.popitem(last=False)
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def stats(self):
+        return {
+            'cache_size': len(self._compressed),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
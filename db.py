@@ -0,0 +1,203 @@
+import functools
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_app_context
+
+DB_PATH = 'users.db'
+
+# Настройки применяются к каждому новому соединению, а не только к соединению init_db
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=10000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    """Все соединения пула заняты дольше, чем acquire_timeout"""
+
+
+def is_busy(e):
+    """Ошибка из-за нагрузки (пул исчерпан, блокировка записи), а не из-за схемы, прав или диска"""
+    message = str(e)
+    return isinstance(e, PoolExhausted) or 'locked' in message or 'busy' in message
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite.
+
+    Поток берёт соединение из пула при первом обращении и держит его до конца
+    app context (teardown возвращает его обратно). Вне контекста Flask
+    соединение возвращается при выходе из самого внешнего `with pool.connection()`.
+    Повторные вызовы в том же потоке получают то же соединение.
+    """
+
+    def __init__(self, path=DB_PATH, max_size=8, statement_cache_size=128, acquire_timeout=10.0):
+        self.path = path
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.acquire_timeout = acquire_timeout
+        self._local = threading.local()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._threadpool = None
+        self.opened = 0
+        # Ожидания свободного соединения и ошибки блокировки SQLite (для метрик)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.locked_errors = 0
+
+    def _connect(self):
+        # check_same_thread=False: соединение переходит между потоками,
+        # но в каждый момент времени им пользуется только один поток
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        self.opened += 1
+        return conn
+
+    def acquire(self):
+        """Возвращает соединение текущего потока, при необходимости берёт его из пула"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            acquired = self._slots.acquire(timeout=self.acquire_timeout)
+            self.waits += 1
+            self.wait_seconds += time.perf_counter() - start
+            if not acquired:
+                raise PoolExhausted(f'no free connection in pool of {self.max_size}')
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+        self._local.conn = conn
+        self._local.depth = 0
+        return conn
+
+    def release(self):
+        """Возвращает соединение текущего потока в пул"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        self._local.depth = 0
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._idle.append(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер для доступа к БД из любого кода"""
+        conn = self.acquire()
+        self._local.depth += 1
+        timeout = getattr(self._local, 'busy_timeout', None)
+        previous = None
+        try:
+            if timeout is not None:
+                previous = conn.execute('PRAGMA busy_timeout').fetchone()[0]
+                conn.execute(f'PRAGMA busy_timeout={int(timeout * 1000)}')
+            yield conn
+        finally:
+            if previous is not None:
+                conn.execute(f'PRAGMA busy_timeout={previous}')
+            self._local.depth -= 1
+            if self._local.depth == 0 and not has_app_context():
+                self.release()
+
+    @contextmanager
+    def busy_timeout(self, seconds):
+        """Запросы блока ждут чужую блокировку записи не дольше seconds (вместо 5 с из PRAGMAS).
+
+        Для записей из запроса: пока блокировку держит другой процесс или поток
+        отложенной записи, страница не должна висеть 5 секунд.
+        """
+        previous = getattr(self._local, 'busy_timeout', None)
+        self._local.busy_timeout = seconds
+        try:
+            yield
+        finally:
+            self._local.busy_timeout = previous
+
+    def close_all(self):
+        """Закрывает все свободные соединения (при остановке приложения)"""
+        self.release()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def offload_to_gevent_threadpool(self):
+        """Под gevent выполняет запросы к SQLite в нативных потоках hub.threadpool.
+
+        Вызовы sqlite3 не уступают управление: без этого ожидание блокировки
+        записи (busy_timeout) останавливало бы весь event loop.
+        """
+        import gevent
+        self._threadpool = gevent.get_hub().threadpool
+        self._threadpool.maxsize = self.max_size
+
+    def run_blocking(self, fn, *args, **kwargs):
+        """Выполняет fn в пуле нативных потоков, если он включён, иначе напрямую"""
+        if self._threadpool is None or getattr(self._local, 'offloaded', False):
+            return fn(*args, **kwargs)
+        busy_timeout = getattr(self._local, 'busy_timeout', None)
+        return self._threadpool.apply(self._run_offloaded, (fn, args, kwargs, busy_timeout))
+
+    def _run_offloaded(self, fn, args, kwargs, busy_timeout=None):
+        # Вложенные вызовы внутри нативного потока выполняются сразу
+        self._local.offloaded = True
+        # busy_timeout() задан в вызывающем гринлете, а соединение - в нативном потоке
+        self._local.busy_timeout = busy_timeout
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._local.offloaded = False
+            self._local.busy_timeout = None
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {
+            'max_size': self.max_size,
+            'opened': self.opened,
+            'idle': idle,
+            'waits': self.waits,
+            'wait_seconds': self.wait_seconds,
+            'locked_errors': self.locked_errors,
+        }
+
+    def init_app(self, app):
+        """Подключает возврат соединения в пул к завершению app context"""
+        app.teardown_appcontext(lambda exc: self.release())
+
+
+def blocking(method):
+    """Помечает метод с запросами к БД: под gevent он уйдёт в пул потоков self.pool"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return self.pool.run_blocking(method, self, *args, **kwargs)
+        except sqlite3.OperationalError as e:
+            # busy_timeout истёк: писатель держал блокировку слишком долго
+            if 'locked' in str(e):
+                self.pool.locked_errors += 1
+            raise
+    return wrapper
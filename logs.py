@@ -0,0 +1,177 @@
+"""Логирование без блокировки обработчика запроса.
+
+Записи попадают в очередь, а в stdout их пишет отдельный поток строками JSON.
+Под gevent это настоящий поток ОС, поэтому медленный сборщик логов не
+останавливает event loop. Уровень задаёт LOG_LEVEL (по умолчанию INFO):
+отладочные вызовы log.debug('...%s', x) на горячем пути тогда стоят одну
+проверку уровня. Повторяющиеся сообщения ограничиваются по частоте.
+"""
+import _thread
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+# Низкоуровневые примитивы: threading.Thread под gevent ждёт запуска на зелёном Event
+try:
+    from gevent import monkey
+    _start_new_thread, _allocate_lock = monkey.get_original('_thread', ['start_new_thread', 'allocate_lock'])
+    _SimpleQueue = monkey.get_original('queue', 'SimpleQueue')
+except ImportError:
+    _start_new_thread, _allocate_lock = _thread.start_new_thread, _thread.allocate_lock
+    _SimpleQueue = queue.SimpleQueue
+
+# Поля LogRecord, которые не переносятся в JSON как extra
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: ts, level, logger, msg, поля extra и исключение"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Не больше burst одинаковых сообщений за interval секунд.
+
+    Одинаковыми считаются записи с общим шаблоном (record.msg до подстановки
+    аргументов). Число отброшенных передаётся в поле suppressed следующей
+    пропущенной записи с тем же шаблоном.
+    """
+
+    def __init__(self, burst=10, interval=60.0, max_keys=10000, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self._clock = clock
+        self._windows = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                dropped = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if dropped:
+                    record.suppressed = dropped
+            if window[1] >= self.burst:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class AsyncHandler(logging.Handler):
+    """Кладёт записи в очередь; target пишет их в фоновом потоке.
+
+    Если очередь длиннее max_queue (писатель не успевает), записи
+    отбрасываются, а не задерживают запросы.
+    """
+
+    def __init__(self, target, max_queue=10000):
+        super().__init__()
+        self.target = target
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._start()
+        # После fork (wsgi.py) потока-писателя в дочернем процессе нет
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = _SimpleQueue()
+        self._stopped = _allocate_lock()
+        self._stopped.acquire()
+        _start_new_thread(self._run, ())
+
+    def emit(self, record):
+        if self._queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        # Подставляем аргументы сейчас: к моменту записи они могут измениться
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self._queue.put(record)
+
+    def _run(self):
+        try:
+            self._write_loop()
+        finally:
+            self._stopped.release()
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                # Писатель один, поэтому без блокировки target.handle()
+                # (под gevent она была бы зелёной и не работала бы из потока ОС)
+                self.target.emit(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def close(self):
+        """Дописывает очередь и останавливает поток"""
+        self._queue.put(None)
+        if self._stopped.acquire(timeout=5):
+            self._stopped.release()
+        self.target.flush()
+        super().close()
+
+    def stats(self):
+        suppressed = sum(getattr(f, 'suppressed', 0) for f in self.filters)
+        return {'queued': self._queue.qsize(), 'dropped': self.dropped, 'suppressed': suppressed}
+
+
+def setup(level='INFO', stream=None, max_queue=10000, burst=10, interval=60.0):
+    """Настраивает корневой логгер.
+
+    Повторный вызов возвращает тот же обработчик и применяет новые level,
+    burst и interval: wsgi.py настраивает логи до импорта app.py.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, AsyncHandler):
+            for log_filter in handler.filters:
+                if isinstance(log_filter, RateLimitFilter):
+                    log_filter.burst = burst
+                    log_filter.interval = interval
+            root.setLevel(level)
+            return handler
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter())
+    handler = AsyncHandler(target, max_queue=max_queue)
+    handler.addFilter(RateLimitFilter(burst=burst, interval=interval))
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.close)
+    return handler
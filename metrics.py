@@ -0,0 +1,148 @@
+"""Метрики Prometheus и профилирование запросов.
+
+/metrics отдаёт гистограммы задержек маршрутов, запросов к БД и обращений
+к кэшу, а также счётчики из stats() компонентов (кэши, пул, очередь записи).
+При нескольких процессах (wsgi.py) задайте PROMETHEUS_MULTIPROC_DIR:
+гистограммы будут суммироваться по всем воркерам.
+
+PROFILING_ENABLED=1 включает профилировщик для отдельных запросов:
+GET /prof?user_id=1&_profile=1 вернёт отчёт вместо страницы (pyinstrument,
+если установлен, иначе cProfile).
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # Сэмплирующий профилировщик необязателен
+    Profiler = None
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Время обработки запроса',
+                            ['route', 'method', 'status'], buckets=LATENCY_BUCKETS)
+DB_LATENCY = Histogram('db_query_duration_seconds', 'Время вызова репозитория (с ожиданием пула)',
+                       ['operation'], buckets=FAST_BUCKETS)
+CACHE_LATENCY = Histogram('cache_lookup_duration_seconds', 'Время обращения к кэшу',
+                          ['cache', 'operation'], buckets=FAST_BUCKETS)
+
+
+class StatsCollector:
+    """Переводит словари stats() компонентов в метрики app_<компонент>_<ключ>"""
+
+    def __init__(self):
+        self._sources = []
+
+    def add(self, name, stats, counters=()):
+        self._sources.append((name, stats, frozenset(counters)))
+
+    def collect(self):
+        for name, stats, counters in self._sources:
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = f'app_{name}_{key}'
+                if key in counters:
+                    family = CounterMetricFamily(metric, f'{name}: {key}')
+                else:
+                    family = GaugeMetricFamily(metric, f'{name}: {key}')
+                family.add_metric([], value)
+                yield family
+
+
+stats_collector = StatsCollector()
+
+
+def register_stats(name, stats, counters=()):
+    """Публикует stats() компонента; ключи из counters - монотонные счётчики"""
+    stats_collector.add(name, stats, counters)
+
+
+def instrument(obj, histogram, *names, **labels):
+    """Оборачивает методы объекта таймером гистограммы (метка operation - имя метода)"""
+    for name in names:
+        method = getattr(obj, name)
+        child = histogram.labels(operation=name, **labels)
+
+        @functools.wraps(method)
+        def timed(*args, _method=method, _child=child, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                _child.observe(time.perf_counter() - start)
+
+        setattr(obj, name, timed)
+
+
+def _registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    # Гистограммы из файлов всех воркеров, stats() - только этого процесса
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(stats_collector)
+    return registry
+
+
+def install(app, profiling=False):
+    """Подключает замеры запросов, маршрут /metrics и профилирование по ?_profile=1"""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        REGISTRY.register(stats_collector)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        if profiling and request.args.get('_profile'):
+            if Profiler is not None:
+                g.profiler = Profiler(interval=0.0005)
+                g.profiler.start()
+            else:
+                g.profiler = cProfile.Profile()
+                g.profiler.enable()
+
+    @app.after_request
+    def record(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            response = _profile_response(profiler)
+        _observe(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_error(exc):
+        # Необработанное исключение: after_request не вызывался
+        if exc is not None:
+            _observe(500)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def _observe(status):
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_LATENCY.labels(route, request.method, status).observe(time.perf_counter() - start)
+
+
+def _profile_response(profiler):
+    if Profiler is not None:
+        profiler.stop()
+        return Response(profiler.output_text(unicode=True), mimetype='text/plain')
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+    return Response(out.getvalue(), mimetype='text/plain')
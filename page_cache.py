@@ -0,0 +1,151 @@
+"""Кэш отрендеренных страниц с ETag и ответами 304"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, render_template, request
+
+
+class PageCache:
+    """LRU-кэш HTML страниц пользователей по ключу (шаблон, lang, user_id, row_version).
+
+    Кэшируются только страницы известного пользователя с языком из langs:
+    остальной контекст рендера вызывающий код берёт из user_data, а не из
+    параметров запроса, иначе случайными параметрами можно было бы вытеснить
+    из кэша все настоящие страницы. Остальные страницы рендерятся каждый раз.
+    При отложенной записи row_version отстаёт от данных в кэше пользователей,
+    поэтому к ключу добавляется хэш user_data; invalidate_user() освобождает
+    память. ETag вычисляется из ключа, так что на If-None-Match ответ 304
+    отдаётся без рендера, даже если страницы нет в кэше.
+    """
+
+    def __init__(self, max_entries=2000, max_bytes=64 * 1024 * 1024, enabled=True, transform=None,
+                 langs=('ru', 'en')):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        # Обработка HTML перед сохранением (например, минификация) - один раз на страницу
+        self.transform = transform
+        self.langs = frozenset(langs)
+        self._data = OrderedDict()
+        self._by_user = {}
+        self._bytes = 0
+        self._template_versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.render_seconds = 0.0
+
+    def _template_version(self, template):
+        version = self._template_versions.get(template)
+        if version is None:
+            env = current_app.jinja_env
+            source = env.loader.get_source(env, template)[0]
+            version = self._template_versions[template] = hashlib.sha1(source.encode()).hexdigest()[:12]
+        return version
+
+    def _etag(self, template, lang, user_data):
+        payload = json.dumps(user_data, sort_keys=True, default=str)
+        key = (f"{template}\0{self._template_version(template)}\0{lang}\0{user_data['user_id']}\0"
+               f"{user_data['row_version']}\0{payload}")
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def cacheable(self, lang, user_data):
+        return (self.enabled and lang in self.langs and user_data is not None
+                and user_data.get('row_version') is not None)
+
+    def render(self, template, lang=None, user_data=None, **context):
+        """Отдаёт страницу из кэша, 304 или рендерит и кэширует (аналог render_template).
+
+        Остальной context должен определяться user_data и lang: он в ключ не входит.
+        """
+        if not self.cacheable(lang, user_data):
+            return render_template(template, lang=lang, user_data=user_data, **context)
+
+        etag = self._etag(template, lang, user_data)
+        if self._not_modified(etag):
+            self.not_modified += 1
+            return self._response(b'', etag, status=304)
+
+        with self._lock:
+            entry = self._data.get(etag)
+            if entry is not None:
+                self._data.move_to_end(etag)
+                self.hits += 1
+        body = entry[0] if entry is not None else None
+        if body is None:
+            start = time.perf_counter()
+            html = render_template(template, lang=lang, user_data=user_data, **context)
+            if self.transform is not None:
+                html = self.transform(html)
+            body = html.encode()
+            self.render_seconds += time.perf_counter() - start
+            self.misses += 1
+            # Страница привязывается к пользователю для invalidate_user()
+            self._store(etag, body, user_data['user_id'])
+        return self._response(body, etag)
+
+    def _not_modified(self, etag):
+        # Flask-Compress дописывает алгоритм к ETag сжатого ответа: "etag:br", "etag:gzip"
+        for tag in request.if_none_match:
+            if tag.split(':', 1)[0] == etag:
+                return True
+        return request.if_none_match.star_tag
+
+    def _response(self, body, etag, status=200):
+        response = Response(body, status=status, mimetype='text/html')
+        response.set_etag(etag)
+        # Страница зависит от пользователя: браузер хранит её, но каждый раз сверяет ETag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _store(self, etag, body, user_id):
+        with self._lock:
+            if etag in self._data:
+                return
+            user_id = int(user_id) if user_id is not None else None
+            self._data[etag] = (body, user_id)
+            self._bytes += len(body)
+            if user_id is not None:
+                self._by_user.setdefault(user_id, set()).add(etag)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                evicted_etag, (evicted, evicted_user) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+                if evicted_user is not None:
+                    etags = self._by_user.get(evicted_user)
+                    etags.discard(evicted_etag)
+                    if not etags:
+                        del self._by_user[evicted_user]
+
+    def invalidate_user(self, user_id):
+        """Удаляет страницы пользователя (вызывается при изменении его записи)"""
+        with self._lock:
+            etags = self._by_user.pop(int(user_id), ())
+            for etag in etags:
+                entry = self._data.pop(etag, None)
+                if entry is not None:
+                    self._bytes -= len(entry[0])
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                # Оценка сэкономленного времени: средний рендер x (попадания + 304)
+                'render_seconds_saved': (self.render_seconds / self.misses * (self.hits + self.not_modified)
+                                         if self.misses else 0.0),
+            }
@@ -0,0 +1,139 @@
+"""Уведомления об изменении пользователя через Socket.IO.
+
+Клиент подключается к /socket.io с auth {"init_data": Telegram.WebApp.initData}
+(или ?init_data=...). Подпись initData проверяется ключом бота
+(TELEGRAM_BOT_TOKEN), и сокет попадает только в комнату своего пользователя
+user:<id>; без токена бота подключения отклоняются. После записи в БД сервер
+отправляет в комнату событие user_updated с изменившимися полями:
+{"user_id": 1, "username": "new"}.
+
+При нескольких процессах (wsgi.py) события рассылаются через Redis
+(message_queue=REDIS_URL): запись в одном воркере доходит до сокетов
+всех остальных. Воркеры не разделяют сессии, поэтому клиенты должны
+подключаться сразу по WebSocket: io(url, {transports: ['websocket']}).
+"""
+import hashlib
+import hmac
+import json
+import logging
+import time
+from urllib.parse import parse_qsl
+
+from flask import request
+from flask_socketio import SocketIO, join_room, leave_room
+
+log = logging.getLogger(__name__)
+
+USER_UPDATED = 'user_updated'
+
+
+def _room(user_id):
+    return f'user:{int(user_id)}'
+
+
+def verify_init_data(init_data, bot_token, max_age=86400, now=None):
+    """user_id из Telegram.WebApp.initData с верной подписью, иначе None.
+
+    Подпись: HMAC-SHA256 отсортированных полей (кроме hash) ключом
+    HMAC-SHA256("WebAppData", токен бота); initData старше max_age секунд не принимается.
+    """
+    if not init_data or not bot_token:
+        return None
+    try:
+        params = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        return None
+    received = params.pop('hash', None)
+    if not received:
+        return None
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(params.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        auth_date = int(params['auth_date'])
+        user_id = int(json.loads(params['user'])['id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if max_age and (now if now is not None else time.time()) - auth_date > max_age:
+        return None
+    return user_id
+
+
+class UserEvents:
+    """Комнаты пользователей и рассылка изменений"""
+
+    def __init__(self, bot_token=None, max_auth_age=86400):
+        self.socketio = SocketIO()
+        self.bot_token = bot_token
+        self.max_auth_age = max_auth_age
+        # Проверенный пользователь каждого сокета (sid -> user_id)
+        self._users = {}
+        self.connected = 0
+        self.rejected = 0
+        self.subscriptions = 0
+        self.published = 0
+
+    def init_app(self, app, message_queue=None, **kwargs):
+        if not self.bot_token:
+            log.warning('TELEGRAM_BOT_TOKEN не задан: подключения к Socket.IO будут отклоняться')
+        try:
+            from gevent import monkey
+            gevent_patched = monkey.is_module_patched('socket')
+        except ImportError:
+            gevent_patched = False
+        # Под wsgi.py - зелёные потоки gevent, под сервером разработки - обычные
+        self.socketio.init_app(app, message_queue=message_queue, channel='user-events',
+                               async_mode='gevent' if gevent_patched else 'threading', **kwargs)
+        self.socketio.on_event('connect', self._on_connect)
+        self.socketio.on_event('disconnect', self._on_disconnect)
+        self.socketio.on_event('subscribe', self._on_subscribe)
+        self.socketio.on_event('unsubscribe', self._on_unsubscribe)
+
+    def _on_connect(self, auth=None):
+        init_data = auth.get('init_data') if isinstance(auth, dict) else request.args.get('init_data')
+        user_id = verify_init_data(init_data, self.bot_token, self.max_auth_age)
+        if user_id is None:
+            self.rejected += 1
+            return False
+        self._users[request.sid] = user_id
+        self.connected += 1
+        join_room(_room(user_id))
+        self.subscriptions += 1
+
+    def _on_disconnect(self):
+        if self._users.pop(request.sid, None) is not None:
+            self.connected -= 1
+
+    def _own_user(self, data):
+        # Подписаться можно только на себя: user_id из запроса должен совпасть с проверенным
+        user_id = self._users.get(request.sid)
+        requested = data.get('user_id', user_id) if isinstance(data, dict) else user_id
+        try:
+            return user_id if user_id is not None and int(requested) == user_id else None
+        except (TypeError, ValueError):
+            return None
+
+    def _on_subscribe(self, data=None):
+        user_id = self._own_user(data)
+        if user_id is None:
+            return {'ok': False, 'error': 'Forbidden'}
+        join_room(_room(user_id))
+        self.subscriptions += 1
+        return {'ok': True}
+
+    def _on_unsubscribe(self, data=None):
+        user_id = self._own_user(data)
+        if user_id is not None:
+            leave_room(_room(user_id))
+        return {'ok': True}
+
+    def publish(self, user_id, **delta):
+        """Отправляет изменившиеся поля подписчикам пользователя (вызывать после коммита)"""
+        self.socketio.emit(USER_UPDATED, {'user_id': int(user_id), **delta}, to=_room(user_id))
+        self.published += 1
+
+    def stats(self):
+        return {'connected': self.connected, 'rejected': self.rejected, 'subscriptions': self.subscriptions,
+                'published': self.published}
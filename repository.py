@@ -0,0 +1,255 @@
+"""Доступ к таблице users и миграции схемы"""
+import logging
+
+from db import blocking
+
+log = logging.getLogger(__name__)
+
+USER_COLUMNS = (
+    'user_id', 'username', 'first_name', 'last_name', 'language_code',
+    'avatar_url', 'custom_username', 'row_version',
+)
+_SELECT_USER = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+# Параметров в одном запросе не больше SQLITE_MAX_VARIABLE_NUMBER (999 в старых сборках)
+GET_MANY_CHUNK = 500
+
+# Обновление только при реальном изменении полей от бота: иначе строка не переписывается
+_UPSERT_VISIT = '''
+    INSERT INTO users (user_id, username, first_name, last_name, language_code)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        language_code = excluded.language_code,
+        row_version = row_version + 1
+    WHERE username IS NOT excluded.username
+       OR first_name IS NOT excluded.first_name
+       OR last_name IS NOT excluded.last_name
+       OR language_code IS NOT excluded.language_code
+'''
+
+
+def _create_users(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER UNIQUE,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            language_code TEXT,
+            avatar_url TEXT,
+            custom_username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_username ON users(username)')
+
+
+def _add_custom_username(conn):
+    # Базы, созданные до появления custom_username
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'custom_username' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN custom_username TEXT')
+
+
+def _drop_duplicate_user_id_index(conn):
+    # UNIQUE(user_id) уже создаёт индекс, idx_user_id лишь удваивал запись
+    conn.execute('DROP INDEX IF EXISTS idx_user_id')
+
+
+def _add_row_version(conn):
+    conn.execute('ALTER TABLE users ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0')
+
+
+# Номер миграции = позиция в списке + 1; текущая версия хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец.
+MIGRATIONS = (
+    _create_users,
+    _add_custom_username,
+    _drop_duplicate_user_id_index,
+    _add_row_version,
+)
+
+
+def _row_to_user(row):
+    user = dict(zip(USER_COLUMNS, row))
+    user['original_username'] = user['username']  # Оригинальный username от бота
+    # Показываем custom_username если он есть, иначе username
+    user['username'] = user['custom_username'] if user['custom_username'] else user['original_username']
+    return user
+
+
+class UserRepository:
+    """Запросы к таблице users.
+
+    Все записи - одиночные UPSERT (ON CONFLICT DO UPDATE): строка обновляется
+    на месте, rowid и created_at не меняются, row_version растёт только
+    при реальном изменении данных.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @blocking
+    def migrate(self):
+        """Применяет недостающие миграции; возвращает итоговую версию схемы.
+
+        Безопасно при одновременном старте нескольких процессов: версия
+        перечитывается под блокировкой записи, и каждая миграция
+        выполняется ровно один раз.
+        """
+        with self.pool.connection() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+                return len(MIGRATIONS)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                applied = []
+                for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {number}')
+                    applied.append(f"{number}: {migration.__name__}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            for name in applied:
+                log.info('Applied migration %s', name)
+            return len(MIGRATIONS)
+
+    @blocking
+    def get(self, user_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(f'{_SELECT_USER} WHERE user_id = ?', (user_id,)).fetchone()
+        return _row_to_user(row) if row else None
+
+    @blocking
+    def get_many(self, user_ids):
+        """Словарь {user_id: пользователь}; запрос WHERE user_id IN (...) на каждые GET_MANY_CHUNK id"""
+        users = {}
+        user_ids = list(user_ids)
+        with self.pool.connection() as conn:
+            for start in range(0, len(user_ids), GET_MANY_CHUNK):
+                chunk = user_ids[start:start + GET_MANY_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                for row in conn.execute(f'{_SELECT_USER} WHERE user_id IN ({placeholders})', chunk):
+                    user = _row_to_user(row)
+                    users[user['user_id']] = user
+        return users
+
+    @blocking
+    def recent(self, limit, before=None):
+        """Последние добавленные пользователи (по убыванию id) и курсор следующей страницы.
+
+        Курсор 0 - страниц больше нет; before=None - с самой новой записи.
+        """
+        query = f"SELECT id, {', '.join(USER_COLUMNS)} FROM users"
+        params = ()
+        if before is not None:
+            query += ' WHERE id < ?'
+            params = (before,)
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'{query} ORDER BY id DESC LIMIT ?', (*params, limit)).fetchall()
+        cursor = rows[-1][0] if len(rows) == limit else 0
+        return [_row_to_user(row[1:]) for row in rows], cursor
+
+    @blocking
+    def row_versions(self, user_ids):
+        """Словарь {user_id: row_version} для существующих пользователей"""
+        versions = {}
+        user_ids = list(user_ids)
+        with self.pool.connection() as conn:
+            for start in range(0, len(user_ids), GET_MANY_CHUNK):
+                chunk = user_ids[start:start + GET_MANY_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                versions.update(conn.execute(
+                    f'SELECT user_id, row_version FROM users WHERE user_id IN ({placeholders})', chunk))
+        return versions
+
+    @blocking
+    def upsert_visit(self, user_id, username, first_name, last_name, language_code):
+        """Сохраняет данные от бота; возвращает (запись до визита или None, актуальная запись).
+
+        Запись до визита читается перед UPSERT: если данные от бота не изменились,
+        блокировка записи не берётся вовсе, и обе записи совпадают.
+        """
+        with self.pool.connection() as conn:
+            row = conn.execute(f'{_SELECT_USER} WHERE user_id = ?', (user_id,)).fetchone()
+            previous = _row_to_user(row) if row else None
+            if previous is not None and (previous['original_username'], previous['first_name'],
+                                         previous['last_name'], previous['language_code']) == \
+                    (username, first_name, last_name, language_code):
+                return previous, previous
+            with conn:
+                row = conn.execute(
+                    f"{_UPSERT_VISIT} RETURNING {', '.join(USER_COLUMNS)}",
+                    (user_id, username, first_name, last_name, language_code),
+                ).fetchone()
+        if row is None:
+            # Другой запрос успел записать те же данные
+            return previous, self.get(user_id)
+        return previous, _row_to_user(row)
+
+    @blocking
+    def upsert_visits(self, rows):
+        """Пакетная версия upsert_visit: rows = {user_id: (username, first_name, last_name, language_code)}"""
+        with self.pool.connection() as conn:
+            with conn:
+                conn.executemany(_UPSERT_VISIT, [(user_id, *row) for user_id, row in rows.items()])
+
+    @blocking
+    def save(self, user_id, username, first_name, last_name, language_code, avatar_url=None):
+        """Сохраняет данные пользователя; avatar_url=None оставляет текущую аватарку"""
+        with self.pool.connection() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name, language_code, avatar_url)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        language_code = excluded.language_code,
+                        avatar_url = COALESCE(excluded.avatar_url, avatar_url),
+                        row_version = row_version + 1
+                    WHERE username IS NOT excluded.username
+                       OR first_name IS NOT excluded.first_name
+                       OR last_name IS NOT excluded.last_name
+                       OR language_code IS NOT excluded.language_code
+                       OR avatar_url IS NOT COALESCE(excluded.avatar_url, avatar_url)
+                ''', (user_id, username, first_name, last_name, language_code, avatar_url))
+
+    @blocking
+    def set_custom_username(self, user_id, custom_username):
+        """Задаёт custom_username, создавая пользователя при необходимости"""
+        with self.pool.connection() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT INTO users (user_id, custom_username) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        custom_username = excluded.custom_username,
+                        row_version = row_version + 1
+                    WHERE custom_username IS NOT excluded.custom_username
+                ''', (user_id, custom_username))
+
+    @blocking
+    def set_avatar_url(self, user_id, avatar_url):
+        """Задаёт avatar_url; строка создаётся, если визит ещё ждёт отложенной записи"""
+        with self.pool.connection() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT INTO users (user_id, avatar_url) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        avatar_url = excluded.avatar_url,
+                        row_version = row_version + 1
+                    WHERE avatar_url IS NOT excluded.avatar_url
+                ''', (user_id, avatar_url))
+
+    @blocking
+    def row_version(self, user_id):
+        """Версия строки для дешёвой проверки изменений (None - пользователя нет)"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT row_version FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,292 @@
+"""Пользователи в нескольких файлах SQLite, разбитых по хэшу user_id.
+
+SQLite допускает одного писателя на файл; при N файлах записи разных
+пользователей идут параллельно, в том числе из разных процессов.
+Включается переменной DB_SHARDS (app.py), по умолчанию - один users.db.
+
+Число шардов нельзя менять на работающей базе: пользователи распределены
+по shard_of(user_id, N). Перераспределение выполняется офлайн:
+    python sharding.py reshard --from users.db --to 'users-{shard}.db' --shards 4
+    python sharding.py reshard --from 'users-{shard}.db' --from-shards 4 --to 'users8-{shard}.db' --shards 8
+    python sharding.py info 'users-{shard}.db' 4
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+
+from db import ConnectionPool
+from repository import UserRepository
+from writer import WriteBehindWriter
+
+
+def shard_of(user_id, shards):
+    """Номер шарда пользователя: одинаков во всех процессах (в отличие от hash())"""
+    # Мультипликативное перемешивание: близкие id Telegram расходятся по разным шардам
+    return (((int(user_id) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+def shard_paths(pattern, shards):
+    return [pattern.format(shard=shard) for shard in range(shards)]
+
+
+class PoolGroup:
+    """Несколько ConnectionPool с интерфейсом одного пула для app.py и wsgi.py"""
+
+    def __init__(self, pools):
+        self.pools = list(pools)
+
+    def init_app(self, app):
+        for pool in self.pools:
+            pool.init_app(app)
+
+    def offload_to_gevent_threadpool(self):
+        for pool in self.pools:
+            pool.offload_to_gevent_threadpool()
+        # Общий пул потоков hub: по max_size потоков на каждый шард
+        self.pools[0]._threadpool.maxsize = sum(pool.max_size for pool in self.pools)
+
+    def close_all(self):
+        for pool in self.pools:
+            pool.close_all()
+
+    @contextmanager
+    def busy_timeout(self, seconds):
+        with ExitStack() as stack:
+            for pool in self.pools:
+                stack.enter_context(pool.busy_timeout(seconds))
+            yield
+
+    def run_blocking(self, fn, *args, **kwargs):
+        # Пул потоков hub общий для всех шардов
+        return self.pools[0].run_blocking(fn, *args, **kwargs)
+
+    def stats(self):
+        total = {}
+        for pool in self.pools:
+            for key, value in pool.stats().items():
+                total[key] = total.get(key, 0) + value
+        total['shards'] = len(self.pools)
+        return total
+
+
+class ShardedUserRepository:
+    """UserRepository поверх N файлов: точечные запросы идут в шард пользователя,
+    пакетные (get_many, upsert_visits) делятся по шардам.
+    """
+
+    def __init__(self, repositories):
+        self.shards = list(repositories)
+        self.pool = PoolGroup(repo.pool for repo in self.shards)
+
+    @classmethod
+    def open(cls, pattern, shards, **pool_options):
+        """Шарды по шаблону пути вида 'users-{shard}.db'"""
+        return cls(UserRepository(ConnectionPool(path, **pool_options)) for path in shard_paths(pattern, shards))
+
+    def shard(self, user_id):
+        return self.shards[shard_of(user_id, len(self.shards))]
+
+    def _group(self, user_ids):
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(shard_of(user_id, len(self.shards)), []).append(user_id)
+        return groups
+
+    def migrate(self):
+        """Миграции во всех шардах и проверка, что файлы созданы для того же числа шардов"""
+        for number, repo in enumerate(self.shards):
+            repo.migrate()
+            with repo.pool.connection() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS shard_info (shard INTEGER NOT NULL, shards INTEGER NOT NULL)')
+                row = conn.execute('SELECT shard, shards FROM shard_info').fetchone()
+                if row is None:
+                    with conn:
+                        conn.execute('INSERT INTO shard_info (shard, shards) VALUES (?, ?)', (number, len(self.shards)))
+                elif row != (number, len(self.shards)):
+                    raise RuntimeError(f'shard file {repo.pool.path} belongs to shard {row[0]} of {row[1]}, '
+                                       f'expected {number} of {len(self.shards)}; run sharding.py reshard')
+        return len(self.shards)
+
+    def get(self, user_id):
+        return self.shard(user_id).get(user_id)
+
+    def get_many(self, user_ids):
+        users = {}
+        for number, ids in self._group(user_ids).items():
+            users.update(self.shards[number].get_many(ids))
+        return users
+
+    def recent(self, limit, before=None):
+        """Поровну новых пользователей из каждого шарда; курсор - кортеж курсоров шардов"""
+        per_shard = -(-limit // len(self.shards))
+        cursors = before or (None,) * len(self.shards)
+        users, next_cursors = [], []
+        for repo, cursor in zip(self.shards, cursors):
+            if cursor == 0:
+                next_cursors.append(0)
+                continue
+            shard_users, cursor = repo.recent(per_shard, cursor)
+            users.extend(shard_users)
+            next_cursors.append(cursor)
+        return users, tuple(next_cursors)
+
+    def row_versions(self, user_ids):
+        versions = {}
+        for number, ids in self._group(user_ids).items():
+            versions.update(self.shards[number].row_versions(ids))
+        return versions
+
+    def upsert_visit(self, user_id, username, first_name, last_name, language_code):
+        return self.shard(user_id).upsert_visit(user_id, username, first_name, last_name, language_code)
+
+    def upsert_visits(self, rows):
+        # Отдельная транзакция в каждом шарде: блокировка записи берётся только на свой файл
+        for number, ids in self._group(rows).items():
+            self.shards[number].upsert_visits({user_id: rows[user_id] for user_id in ids})
+
+    def save(self, user_id, username, first_name, last_name, language_code, avatar_url=None):
+        return self.shard(user_id).save(user_id, username, first_name, last_name, language_code, avatar_url)
+
+    def set_custom_username(self, user_id, custom_username):
+        return self.shard(user_id).set_custom_username(user_id, custom_username)
+
+    def set_avatar_url(self, user_id, avatar_url):
+        return self.shard(user_id).set_avatar_url(user_id, avatar_url)
+
+    def row_version(self, user_id):
+        return self.shard(user_id).row_version(user_id)
+
+
+class ShardedWriter:
+    """WriteBehindWriter со своим потоком на каждый шард, интерфейс одного писателя для app.py.
+
+    Пачки разных шардов пишутся параллельно, каждая - одной транзакцией
+    в своём файле. max_pending делится между шардами.
+    """
+
+    def __init__(self, write_batches, max_pending=10000, **options):
+        write_batches = list(write_batches)
+        per_shard = max(1, max_pending // len(write_batches))
+        self.writers = [WriteBehindWriter(write_batch, max_pending=per_shard, name=f'user-write-behind-{number}',
+                                          **options)
+                        for number, write_batch in enumerate(write_batches)]
+
+    def writer(self, user_id):
+        return self.writers[shard_of(user_id, len(self.writers))]
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def submit(self, user_id, row):
+        return self.writer(user_id).submit(user_id, row)
+
+    def pending_for(self, user_id):
+        return self.writer(user_id).pending_for(user_id)
+
+    def pending_count(self):
+        return sum(writer.pending_count() for writer in self.writers)
+
+    def flush(self):
+        return sum(writer.flush() for writer in self.writers)
+
+    def stop(self, timeout=10.0):
+        for writer in self.writers:
+            writer.stop(timeout)
+
+    def stats(self):
+        total = {}
+        for writer in self.writers:
+            for key, value in writer.stats().items():
+                total[key] = total.get(key, 0) + value
+        total['shards'] = len(self.writers)
+        return total
+
+
+def _source_paths(source, source_shards):
+    return shard_paths(source, source_shards) if source_shards else [source]
+
+
+def reshard(sources, pattern, shards, batch=50_000):
+    """Копирует пользователей из sources в новые шарды по шаблону pattern; возвращает число строк"""
+    targets = shard_paths(pattern, shards)
+    existing = [path for path in targets if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f'target shards already exist: {", ".join(existing)}')
+    repo = ShardedUserRepository.open(pattern, shards, max_size=1)
+    repo.migrate()
+    conns = [pool.acquire() for pool in repo.pool.pools]
+    for conn in conns:
+        # Офлайн-копия: при сбое шарды создаются заново, fsync не нужен
+        conn.execute('PRAGMA synchronous=OFF')
+
+    copied = 0
+    try:
+        for path in sources:
+            source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            # Все колонки, кроме локального id: его назначает целевой файл
+            columns = [row[1] for row in source.execute('PRAGMA table_info(users)') if row[1] != 'id']
+            user_id_index = columns.index('user_id')
+            insert = (f"INSERT INTO users ({', '.join(columns)}) "
+                      f"VALUES ({', '.join('?' * len(columns))})")
+            cursor = source.execute(f"SELECT {', '.join(columns)} FROM users")
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                grouped = {}
+                for row in rows:
+                    grouped.setdefault(shard_of(row[user_id_index], shards), []).append(row)
+                for number, shard_rows in grouped.items():
+                    with conns[number]:
+                        conns[number].executemany(insert, shard_rows)
+                copied += len(rows)
+            source.close()
+        for conn in conns:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        for pool in repo.pool.pools:
+            pool.release()
+        repo.pool.close_all()
+    return copied
+
+
+def info(pattern, shards):
+    """Число пользователей в каждом шарде"""
+    rows = []
+    for path in shard_paths(pattern, shards):
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        rows.append((path, conn.execute('SELECT COUNT(*) FROM users').fetchone()[0], os.path.getsize(path)))
+        conn.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Шардирование users.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    reshard_parser = commands.add_parser('reshard', help='офлайн-перераспределение пользователей')
+    reshard_parser.add_argument('--from', dest='source', required=True, help="users.db или шаблон 'users-{shard}.db'")
+    reshard_parser.add_argument('--from-shards', type=int, default=0, help='число исходных шардов (0 - один файл)')
+    reshard_parser.add_argument('--to', dest='target', required=True, help="шаблон 'users-{shard}.db'")
+    reshard_parser.add_argument('--shards', type=int, required=True)
+    info_parser = commands.add_parser('info', help='размер шардов')
+    info_parser.add_argument('pattern')
+    info_parser.add_argument('shards', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        for path, count, size in info(args.pattern, args.shards):
+            print(f"{path:<32} {count:10} users  {size / 2 ** 20:8.1f} MiB")
+        return
+    if '{shard}' not in args.target:
+        sys.exit("--to must contain {shard}")
+    start = time.perf_counter()
+    copied = reshard(_source_paths(args.source, args.from_shards), args.target, args.shards)
+    print(f"copied {copied} users into {args.shards} shards in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
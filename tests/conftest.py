@@ -0,0 +1,40 @@
+"""Общие фикстуры: приложение на временной БД с заглушками шаблонов.
+
+Зависимости тестов: pip install -r requirements-dev.txt
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+USER_ID = 7001
+PAGE_TEMPLATES = ('index.html', 'user.html', 'prof.html', 'glav.html', 'settings.html', 'info.html', 'deepseek.html')
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('app')
+    # В репозитории нет templates/: страницам хватает заглушек с данными пользователя
+    templates = tmp / 'templates'
+    templates.mkdir()
+    for name in PAGE_TEMPLATES:
+        (templates / name).write_text('{{ username }} {{ first_name }} {{ user_data.avatar_url if user_data }}',
+                                      encoding='utf-8')
+    os.environ.update({
+        'DB_PATH': str(tmp / 'users.db'),
+        'TEMPLATE_DIR': str(templates),
+        'ASSET_DIR': str(tmp / 'assets'),
+        'CACHE_WARMUP_USERS': '0',
+        'USER_WRITE_MODE': 'sync',
+    })
+    os.environ.pop('REDIS_URL', None)
+    os.environ.pop('DB_SHARDS', None)
+    module = importlib.import_module('app')
+    module.create_app()
+    module.user_repo.save(USER_ID, 'bot', 'Ivan', 'Petrov', 'ru', '/avatars/7001.jpg')
+    yield module
+    module.shutdown()
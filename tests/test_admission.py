@@ -0,0 +1,43 @@
+"""Запись из запроса при чужой блокировке SQLite: быстрый отказ вместо ожидания busy_timeout.
+
+    python -m pytest -q tests
+"""
+import sqlite3
+import time
+
+import pytest
+
+from conftest import USER_ID
+
+
+@pytest.fixture
+def locked_db(app_module):
+    # Блокировку записи держит другое соединение (как другой воркер или поток отложенной записи)
+    conn = sqlite3.connect(app_module.db_pool.path, isolation_level=None)
+    conn.execute('BEGIN IMMEDIATE')
+    yield
+    conn.rollback()
+    conn.close()
+
+
+def test_visit_falls_back_without_waiting(app_module, locked_db):
+    client = app_module.app.test_client()
+    app_module.user_cache.invalidate(USER_ID)
+    shed = app_module.write_limiter.stats()['shed_busy']
+    start = time.perf_counter()
+    response = client.get(f'/?user_id={USER_ID}&username=visitor')
+    assert response.status_code == 200
+    assert time.perf_counter() - start < 2
+    assert app_module.write_limiter.stats()['shed_busy'] == shed + 1
+
+
+def test_username_update_returns_503_without_waiting(app_module, locked_db):
+    client = app_module.app.test_client()
+    stats = app_module.write_limiter.stats()
+    start = time.perf_counter()
+    response = client.post('/api/username', json={'user_id': USER_ID + 100, 'username': 'busy'})
+    assert response.status_code == 503
+    assert time.perf_counter() - start < 2
+    after = app_module.write_limiter.stats()
+    assert after['shed_busy'] == stats['shed_busy'] + 1
+    assert after['shed'] == stats['shed'] + 1
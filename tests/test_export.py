@@ -0,0 +1,38 @@
+"""Выгрузка /api/export/users: проверка параметров до начала потока.
+
+    python -m pytest -q tests
+"""
+import json
+
+import pytest
+
+from bulk import iter_users
+
+TOKEN = 'test-export-token'
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_TOKEN', TOKEN)
+    return app_module.app.test_client()
+
+
+def _export(client, query):
+    return client.get(f'/api/export/users?{query}', headers={'Authorization': f'Bearer {TOKEN}'})
+
+
+@pytest.mark.parametrize('query', ['limit=-1', 'after=-5', 'limit=x'])
+def test_invalid_range_is_rejected(client, query):
+    assert _export(client, query).status_code == 400
+
+
+def test_limit_bounds_rows(client):
+    response = _export(client, 'limit=1')
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(rows) == 1
+
+
+def test_iter_users_rejects_negative_limit(app_module):
+    with pytest.raises(ValueError):
+        next(iter_users(app_module.db_pool.path, limit=-1))
@@ -0,0 +1,46 @@
+"""PageCache: страницы кэшируются по (шаблон, lang, user_id, row_version), параметры запроса кэш не засоряют.
+
+    python -m pytest -q tests
+"""
+import pytest
+
+from conftest import USER_ID
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.page_cache.invalidate_user(USER_ID)
+    return app_module.app.test_client()
+
+
+def test_query_params_do_not_create_entries(app_module, client):
+    page_cache = app_module.page_cache
+    size = page_cache.stats()['size']
+    for i in range(20):
+        response = client.get(f'/prof?user_id={USER_ID}&username=spam{i}&first_name=spam{i}&last_name=x{i}')
+        # Для известного пользователя страница строится из БД
+        assert response.get_data(as_text=True).startswith('bot Ivan')
+    assert page_cache.stats()['size'] == size + 1
+
+
+def test_unknown_user_and_lang_are_not_cached(app_module, client):
+    page_cache = app_module.page_cache
+    size = page_cache.stats()['size']
+    for i in range(5):
+        response = client.get(f'/prof?user_id={USER_ID + 1 + i}&username=guest&first_name=Guest')
+        assert response.get_data(as_text=True).startswith('guest Guest')
+        assert 'ETag' not in response.headers
+        client.get(f'/prof?user_id={USER_ID}&lang=xx{i}')
+    assert page_cache.stats()['size'] == size
+
+
+def test_changed_user_gets_new_page(app_module, client):
+    first = client.get(f'/glav?user_id={USER_ID}')
+    assert client.get(f'/glav?user_id={USER_ID}', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    app_module.user_repo.set_custom_username(USER_ID, 'renamed')
+    app_module.user_cache.invalidate(USER_ID)
+    second = client.get(f'/glav?user_id={USER_ID}', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.get_data(as_text=True).startswith('renamed')
+    app_module.user_repo.set_custom_username(USER_ID, None)
+    app_module.user_cache.invalidate(USER_ID)
@@ -0,0 +1,72 @@
+"""Socket.IO: проверка initData и рассылка user_updated только при реальном изменении.
+
+    python -m pytest -q tests
+"""
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+from realtime import verify_init_data
+
+BOT_TOKEN = '123456:test-token'
+
+
+def _init_data(user_id, auth_date=None, bot_token=BOT_TOKEN):
+    params = {'auth_date': str(int(auth_date or time.time())), 'user': json.dumps({'id': user_id})}
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(params.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    params['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(params)
+
+
+def test_valid_signature():
+    assert verify_init_data(_init_data(42), BOT_TOKEN) == 42
+
+
+def test_forged_hash():
+    forged = _init_data(42).replace('hash=', 'hash=0')
+    assert verify_init_data(forged, BOT_TOKEN) is None
+    # Подпись чужим токеном и подмена user_id при верном hash
+    assert verify_init_data(_init_data(42, bot_token='654321:other'), BOT_TOKEN) is None
+    assert verify_init_data(_init_data(42).replace('%3A+42', '%3A+43'), BOT_TOKEN) is None
+
+
+def test_expired_auth_date():
+    old = _init_data(42, auth_date=time.time() - 2 * 86400)
+    assert verify_init_data(old, BOT_TOKEN, max_age=86400) is None
+    assert verify_init_data(old, BOT_TOKEN, max_age=3 * 86400) == 42
+
+
+@pytest.fixture
+def published(app_module, monkeypatch):
+    events = []
+    monkeypatch.setattr(app_module.user_events, 'publish', lambda user_id, **fields: events.append((user_id, fields)))
+    return events
+
+
+@pytest.mark.parametrize('mode', ['sync', 'behind'])
+def test_visit_publishes_only_changes(app_module, published, monkeypatch, mode):
+    monkeypatch.setattr(app_module, 'USER_WRITE_MODE', mode)
+    client = app_module.app.test_client()
+    user_id = 8000 if mode == 'sync' else 8001
+    visit = f'/?user_id={user_id}&username=u{user_id}&first_name=Ann&last_name=Lee&lang=ru'
+    client.get(visit)
+    app_module.user_writer.flush()
+    assert published == [(user_id, {'username': f'u{user_id}', 'first_name': 'Ann', 'last_name': 'Lee'})]
+    row_version = app_module.user_repo.row_version(user_id)
+
+    del published[:]
+    for _ in range(4):
+        app_module.user_cache.clear()
+        client.get(visit)
+        app_module.user_writer.flush()
+    assert published == []
+    assert app_module.user_repo.row_version(user_id) == row_version
+
+    client.get(visit.replace('first_name=Ann', 'first_name=Anna'))
+    app_module.user_writer.flush()
+    assert published == [(user_id, {'first_name': 'Anna'})]
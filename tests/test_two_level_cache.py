@@ -0,0 +1,69 @@
+"""TwoLevelUserCache: инвалидации за время сбоя Redis и устаревшие загрузки не оставляют старых данных в L2.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q tests
+"""
+import pytest
+
+from cache import TwoLevelUserCache, UserCache, UserLookup
+
+fakeredis = pytest.importorskip('fakeredis', reason='pip install -r requirements-dev.txt')
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def _worker(server, db, **options):
+    cache = TwoLevelUserCache(UserCache(ttl=30), fakeredis.FakeRedis(server=server), ttl=300, **options)
+    return cache, UserLookup(cache, lambda user_id: dict(db[user_id]))
+
+
+def test_invalidation_during_outage_is_replayed(server):
+    db = {1: {'username': 'old'}}
+    a, _ = _worker(server, db, retry_interval=0)
+    b, lookup_b = _worker(server, db)
+    assert lookup_b.get(1) == {'username': 'old'}
+
+    server.connected = False
+    db[1] = {'username': 'new'}
+    a.invalidate(1)
+    assert a.stats()['l2_pending_invalidations'] == 1
+    server.connected = True
+
+    a.get(2)  # первое обращение к Redis после сбоя
+    assert a.stats()['l2_pending_invalidations'] == 0
+    b.l1.clear()
+    assert lookup_b.get(1) == {'username': 'new'}
+
+
+def test_pending_overflow_flushes_l2(server):
+    client = fakeredis.FakeRedis(server=server)
+    client.set('user:5', '{"username": "old"}')
+    cache, _ = _worker(server, {}, retry_interval=0, max_pending=2)
+    server.connected = False
+    for user_id in range(5):
+        cache.invalidate(user_id)
+    server.connected = True
+    cache.get(9)
+    assert client.get('user:5') is None
+
+
+def test_load_raced_with_remote_invalidation_is_not_stored(server):
+    db = {1: {'username': 'v1'}}
+    a, lookup_a = _worker(server, db)
+    b, _ = _worker(server, db)
+
+    def slow_loader(user_id):
+        value = dict(db[user_id])
+        # Пока b читает БД, a записывает новое значение
+        db[user_id] = {'username': 'v2'}
+        a.invalidate(user_id)
+        return value
+
+    UserLookup(b, slow_loader).get(1)
+    assert fakeredis.FakeRedis(server=server).get('user:1') is None
+    assert lookup_a.get(1) == {'username': 'v2'}
+    b.l1.clear()
+    assert UserLookup(b, lambda user_id: dict(db[user_id])).get(1) == {'username': 'v2'}
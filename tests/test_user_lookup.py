@@ -0,0 +1,161 @@
+"""UserLookup: тёплый кэш не ходит в БД, инвалидация другого ключа не мешает кэшировать промах.
+
+    python -m pytest -q tests
+"""
+import threading
+
+import pytest
+
+from cache import UserCache, UserLookup
+from conftest import USER_ID
+
+
+def test_unrelated_invalidation_does_not_block_caching():
+    cache = UserCache()
+    calls = []
+
+    def loader(user_id):
+        calls.append(user_id)
+        # Пока идёт чтение из БД, пишется другой пользователь
+        cache.invalidate(user_id + 1)
+        return {'user_id': user_id}
+
+    lookup = UserLookup(cache, loader)
+    for _ in range(3):
+        assert lookup.get(1) == {'user_id': 1}
+    assert calls == [1]
+    assert cache.get(1) == {'user_id': 1}
+
+
+def test_same_key_invalidation_drops_stale_load():
+    cache = UserCache()
+
+    def loader(user_id):
+        cache.invalidate(user_id)
+        return {'user_id': user_id, 'username': 'old'}
+
+    UserLookup(cache, loader).get(1)
+    assert cache.get(1) is None
+
+
+def test_many_unrelated_invalidation_does_not_block_caching():
+    cache = UserCache()
+    calls = []
+
+    def many_loader(user_ids):
+        calls.append(list(user_ids))
+        cache.invalidate(999)
+        return {user_id: {'user_id': user_id} for user_id in user_ids}
+
+    lookup = UserLookup(cache, lambda user_id: None, many_loader=many_loader)
+    lookup.get_many([1, 2])
+    lookup.get_many([1, 2])
+    assert calls == [[1, 2]]
+
+
+def test_evicted_tombstone_still_marks_old_loads_stale():
+    cache = UserCache(max_tombstones=2)
+    generation = cache.generation
+    cache.invalidate(1)
+    cache.invalidate(2)
+    cache.invalidate(3)  # запись о ключе 1 вытеснена
+    cache.set(1, {'user_id': 1}, generation=generation)
+    assert cache.get(1) is None
+    cache.set(1, {'user_id': 1}, generation=cache.generation)
+    assert cache.get(1) == {'user_id': 1}
+
+
+@pytest.fixture
+def db_reads(app_module, monkeypatch):
+    reads = []
+    repo = app_module.user_repo
+    get, get_many = repo.get, repo.get_many
+
+    def counting_get(user_id):
+        reads.append(user_id)
+        return get(user_id)
+
+    def counting_get_many(user_ids):
+        reads.append(tuple(user_ids))
+        return get_many(user_ids)
+
+    monkeypatch.setattr(repo, 'get', counting_get)
+    monkeypatch.setattr(repo, 'get_many', counting_get_many)
+    app_module.user_cache.clear()
+    return reads
+
+
+@pytest.mark.parametrize('path', [
+    f'/user?user_id={USER_ID}',
+    f'/prof?user_id={USER_ID}',
+    f'/glav?user_id={USER_ID}',
+    f'/settings?user_id={USER_ID}',
+    f'/info?user_id={USER_ID}',
+    f'/deepseek?user_id={USER_ID}',
+    f'/api/user/{USER_ID}/username',
+    f'/api/user/{USER_ID}/avatar',
+    f'/api/users?ids={USER_ID}',
+])
+def test_warm_cache_route_does_not_read_db(app_module, db_reads, path):
+    client = app_module.app.test_client()
+    assert client.get(path).status_code == 200
+    assert len(db_reads) == 1  # холодный кэш: одно чтение
+    del db_reads[:]
+    for _ in range(3):
+        assert client.get(path).status_code == 200
+    assert db_reads == []
+
+
+def test_concurrent_cold_misses_read_db_once(app_module, db_reads):
+    client = app_module.app.test_client()
+    barrier = threading.Barrier(8)
+
+    def request():
+        barrier.wait()
+        client.get(f'/api/user/{USER_ID}/username')
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(db_reads) == 1
+    del db_reads[:]
+    client.get(f'/api/user/{USER_ID}/username')
+    assert db_reads == []
+
+
+@pytest.mark.parametrize('mode', ['sync', 'behind'])
+def test_visit_does_not_cache_over_concurrent_username(app_module, monkeypatch, mode):
+    monkeypatch.setattr(app_module, 'USER_WRITE_MODE', mode)
+    user_id = 8100 if mode == 'sync' else 8101
+    app_module.user_repo.set_custom_username(user_id, 'old')
+    app_module.user_cache.clear()
+    repo, writer = app_module.user_repo, app_module.user_writer
+    upsert_visit, submit = repo.upsert_visit, writer.submit
+
+    def set_username():
+        # POST /api/username между чтением записи и set() визита
+        repo.set_custom_username(user_id, 'new')
+        app_module.user_cache.invalidate(user_id)
+
+    def racing_upsert_visit(*args):
+        result = upsert_visit(*args)
+        set_username()
+        return result
+
+    def racing_submit(*args):
+        set_username()
+        return submit(*args)
+
+    monkeypatch.setattr(repo, 'upsert_visit', racing_upsert_visit)
+    monkeypatch.setattr(writer, 'submit', racing_submit)
+    app_module._update_user_in_db_and_cache(user_id, 'bot', 'Ivan', 'Petrov', 'ru')
+    writer.flush()
+    assert app_module.user_lookup.get(user_id)['username'] == 'new'
+
+
+@pytest.mark.parametrize('body', [[1], 'x', 5, {'ids': '123'}, {'ids': {'1': 1}}])
+def test_users_batch_rejects_malformed_body(app_module, body):
+    response = app_module.app.test_client().post('/api/users', json=body)
+    assert response.status_code == 400
@@ -0,0 +1,185 @@
+"""Прогрев кэша пользователей при старте и снимок кэша между перезапусками.
+
+После деплоя пустой кэш отправляет первую волну запросов в SQLite.
+CacheWarmer в фоне:
+1. читает снимок кэша, записанный при прошлой остановке (CACHE_SNAPSHOT_PATH),
+   и возвращает в кэш записи, которые не изменились в БД (сверка row_version);
+2. догружает из БД последних добавленных пользователей до max_users.
+Прогрев ограничен по времени (budget) и не блокирует обработку запросов;
+ход прогрева отдаёт /ready.
+
+Формат снимка (little-endian), читается через mmap без загрузки файла целиком:
+    заголовок: magic b'UCSNAP01', число записей uint32, время записи float64 (unix)
+    индекс:    user_id int64, row_version int64, смещение uint32, длина uint32,
+               оставшийся TTL float32 - от давно использованных к недавним
+    данные:    JSON записей подряд
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'UCSNAP01'
+_HEADER = struct.Struct('<8sId')
+_ENTRY = struct.Struct('<qqIIf')
+
+
+def write_snapshot(path, items):
+    """Записывает [(user_id, данные, оставшийся TTL)] атомарно (tmp + rename); возвращает число записей"""
+    index, blobs, offset = [], [], 0
+    for user_id, value, ttl in items:
+        blob = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+        index.append(_ENTRY.pack(user_id, value.get('row_version') or 0, offset, len(blob), ttl))
+        blobs.append(blob)
+        offset += len(blob)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, len(index), time.time()))
+        f.writelines(index)
+        f.writelines(blobs)
+    # Несколько воркеров пишут один файл: каждый целиком, остаётся последний
+    os.replace(tmp, path)
+    return len(index)
+
+
+def read_snapshot(path):
+    """Записи снимка [(user_id, row_version, данные, оставшийся TTL)]; устаревшие по TTL пропускаются"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, count, saved_at = _HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path}: not a cache snapshot')
+        age = max(time.time() - saved_at, 0.0)
+        base = _HEADER.size + count * _ENTRY.size
+        entries = []
+        for user_id, row_version, offset, length, ttl in _ENTRY.iter_unpack(data[_HEADER.size:base]):
+            if ttl - age > 0:
+                entries.append((user_id, row_version, json.loads(data[base + offset:base + offset + length]),
+                                ttl - age))
+    return entries
+
+
+class CacheWarmer:
+    """Прогрев UserCache снимком и свежими пользователями из БД в фоновом потоке"""
+
+    def __init__(self, cache, repo, max_users=5000, budget=2.0, snapshot_path=None, batch=500,
+                 clock=time.monotonic):
+        # У TwoLevelUserCache прогреваем только L1: Redis переживает перезапуск сам
+        self.cache = getattr(cache, 'l1', cache)
+        self.repo = repo
+        self.max_users = min(max_users, self.cache.max_entries)
+        self.budget = budget
+        self.snapshot_path = snapshot_path
+        self.batch = batch
+        self._clock = clock
+        self._thread = None
+        self._started_at = None
+        self._finished_at = None
+        self.state = 'pending'
+        self.restored = 0
+        self.stale = 0
+        self.loaded = 0
+        self.saved = 0
+
+    @property
+    def done(self):
+        return self.state in ('done', 'budget_exceeded', 'failed')
+
+    def start(self):
+        if self._thread is None:
+            self._started_at = self._clock()
+            self.state = 'running'
+            self._thread = threading.Thread(target=self.run, name='cache-warmup', daemon=True)
+            self._thread.start()
+
+    def _over_budget(self):
+        return self._clock() - self._started_at >= self.budget
+
+    def run(self):
+        if self._started_at is None:
+            self._started_at = self._clock()
+        try:
+            complete = self._restore_snapshot() and self._load_recent()
+            self.state = 'done' if complete else 'budget_exceeded'
+        except Exception:
+            log.exception('Ошибка прогрева кэша пользователей')
+            self.state = 'failed'
+        self._finished_at = self._clock()
+        log.info('Прогрев кэша: %s, из снимка %s (устарело %s), из БД %s за %.2fs', self.state, self.restored,
+                 self.stale, self.loaded, self._finished_at - self._started_at)
+
+    def _restore_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return True
+        try:
+            entries = read_snapshot(self.snapshot_path)
+        except (OSError, ValueError, struct.error) as e:
+            log.warning('Снимок кэша %s не прочитан: %s', self.snapshot_path, e)
+            return True
+        # Самые недавние в конце снимка; если места не хватит, берём их
+        entries = entries[-self.cache.max_entries:]
+        for start in range(0, len(entries), self.batch):
+            if self._over_budget():
+                return False
+            chunk = entries[start:start + self.batch]
+            generation = self.cache.generation
+            # Пока процесс не работал, записи могли измениться в БД
+            versions = self.repo.row_versions([entry[0] for entry in chunk])
+            for user_id, row_version, value, ttl in chunk:
+                if versions.get(user_id) != row_version:
+                    self.stale += 1
+                    continue
+                self.cache.set(user_id, value, generation=generation, ttl=ttl)
+                self.restored += 1
+            time.sleep(0)  # Под gevent уступаем обработке запросов
+        return True
+
+    def _load_recent(self):
+        cursor = None
+        while len(self.cache) < self.max_users:
+            if self._over_budget():
+                return False
+            generation = self.cache.generation
+            users, cursor = self.repo.recent(self.batch, cursor)
+            if not users:
+                break
+            for user in users:
+                if len(self.cache) >= self.max_users:
+                    break
+                if user['user_id'] not in self.cache:
+                    self.cache.set(user['user_id'], user, generation=generation)
+                    self.loaded += 1
+            time.sleep(0)
+        return True
+
+    def save_snapshot(self):
+        """Записывает кэш на диск (при корректной остановке)"""
+        items = self.cache.items() if self.snapshot_path else None
+        if not items:
+            # Пустой кэш (остановка сразу после старта) не затирает прошлый снимок
+            return 0
+        try:
+            self.saved = write_snapshot(self.snapshot_path, items)
+        except OSError as e:
+            log.warning('Снимок кэша %s не записан: %s', self.snapshot_path, e)
+            return 0
+        log.info('Снимок кэша: %s записей в %s', self.saved, self.snapshot_path)
+        return self.saved
+
+    def stats(self):
+        end = self._finished_at if self._finished_at is not None else self._clock()
+        return {
+            'state': self.state,
+            'done': self.done,
+            'restored': self.restored,
+            'stale': self.stale,
+            'loaded': self.loaded,
+            'target': self.max_users,
+            'cached': len(self.cache),
+            'seconds': end - self._started_at if self._started_at is not None else 0.0,
+            'budget': self.budget,
+        }
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindWriter:
+    """Отложенная пакетная запись изменений пользователей.
+
+    Запрос только кладёт изменение в очередь; фоновый поток склеивает
+    изменения одного пользователя и сбрасывает их одной транзакцией
+    каждые flush_interval секунд или при накоплении max_batch строк.
+    Очередь ограничена max_pending пользователями: при переполнении submit
+    ждёт до submit_timeout и возвращает False, чтобы вызывающий код
+    записал изменение синхронно. on_flush(batch) вызывается после
+    каждой успешно записанной пачки {user_id: row}.
+    """
+
+    def __init__(self, write_batch, flush_interval=0.05, max_batch=500,
+                 max_pending=10000, submit_timeout=0.5, on_flush=None, name='user-write-behind'):
+        self.write_batch = write_batch
+        self.name = name
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._pending = {}
+        self._flushing = {}
+        self._cond = threading.Condition()
+        # Сериализует сбросы, чтобы старая версия строки не перезаписала новую
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.errors = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id, row):
+        """Ставит строку пользователя в очередь; False - очередь переполнена"""
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            if self._stopping:
+                self.rejected += 1
+                return False
+            self.submitted += 1
+            if user_id in self._pending:
+                self._pending[user_id] = row
+                self.coalesced += 1
+                return True
+            deadline = time.monotonic() + self.submit_timeout
+            while len(self._pending) >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping:
+                    self.rejected += 1
+                    return False
+                self._cond.wait(remaining)
+            self._pending[user_id] = row
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+            return True
+
+    def pending_for(self, user_id):
+        """Строка пользователя, ещё не записанная в БД, или None"""
+        with self._cond:
+            row = self._pending.get(user_id)
+            if row is None:
+                row = self._flushing.get(user_id)
+            return row
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending) + len(self._flushing)
+
+    def flush(self):
+        """Синхронно записывает всё накопленное; возвращает число строк"""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+                self._cond.notify_all()
+            if not batch:
+                return 0
+            try:
+                # write_batch пишет всю пачку одной транзакцией
+                self.write_batch(batch)
+            except Exception:
+                self.errors += 1
+                log.exception('Ошибка отложенной записи пользователей')
+                with self._cond:
+                    # Возвращаем в очередь строки, которые не были перезаписаны новыми
+                    for user_id, row in batch.items():
+                        self._pending.setdefault(user_id, row)
+                    self._flushing = {}
+                return 0
+            with self._cond:
+                self._flushing = {}
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+        if self.on_flush is not None:
+            try:
+                self.on_flush(batch)
+            except Exception:
+                log.exception('Ошибка обработчика on_flush')
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._pending) < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            errors = self.errors
+            self.flush()
+            if stopping:
+                return
+            if self.errors != errors:
+                # БД недоступна: не крутимся в цикле, ждём следующий интервал
+                time.sleep(self.flush_interval)
+
+    def stop(self, timeout=10.0):
+        """Останавливает поток, предварительно записав все изменения"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending) + len(self._flushing),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'errors': self.errors,
+            }
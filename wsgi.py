@@ -0,0 +1,160 @@
+"""Продакшен-запуск приложения на gevent.
+
+python wsgi.py - слушает HOST:PORT и запускает WEB_WORKERS процессов (pre-fork),
+каждый обслуживает до WEB_MAX_CONNECTIONS одновременных соединений.
+Упавший воркер перезапускается; если воркеры падают быстрее WEB_MIN_UPTIME
+секунд после старта, перезапуск откладывается (экспоненциально, до
+WEB_RESPAWN_MAX_DELAY), а после WEB_MAX_STARTUP_FAILURES таких падений подряд
+мастер останавливается с ненулевым кодом.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import os
+import resource
+import signal
+import socket
+import time
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from logs import setup as setup_logging
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8000))
+WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+MAX_CONNECTIONS = int(os.environ.get('WEB_MAX_CONNECTIONS', 1000))
+BACKLOG = int(os.environ.get('WEB_BACKLOG', 2048))
+SHUTDOWN_TIMEOUT = float(os.environ.get('WEB_SHUTDOWN_TIMEOUT', 10))
+MIN_UPTIME = float(os.environ.get('WEB_MIN_UPTIME', 5))
+RESPAWN_MAX_DELAY = float(os.environ.get('WEB_RESPAWN_MAX_DELAY', 30))
+MAX_STARTUP_FAILURES = int(os.environ.get('WEB_MAX_STARTUP_FAILURES', 5))
+
+log = logging.getLogger('wsgi')
+
+
+class Server(WSGIServer):
+    def handle(self, sock, address):
+        # Без TCP_NODELAY ответы keep-alive ждут ~40 мс (Nagle + delayed ACK)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().handle(sock, address)
+
+
+def _listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(BACKLOG)
+    return sock
+
+
+def serve(listener):
+    """Рабочий процесс: приложение импортируется уже после fork"""
+    import app as app_module
+
+    # SQLite не умеет уступать управление - запросы уходят в нативные потоки
+    app_module.db_pool.offload_to_gevent_threadpool()
+    application = app_module.create_app()
+
+    server = Server(listener, application, spawn=Pool(MAX_CONNECTIONS), log=None)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        gevent.signal_handler(signum, lambda: gevent.spawn(server.stop, SHUTDOWN_TIMEOUT))
+    log.info('Worker %s serving on %s:%s', os.getpid(), HOST, PORT)
+    server.serve_forever()
+    app_module.shutdown()
+
+
+def _raise_fd_limit():
+    # Каждое WebSocket-соединение занимает два дескриптора (simple-websocket делает dup)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _reset_metrics_dir():
+    # Файлы метрик прошлых запусков иначе попадут в сумму по воркерам
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+
+def main():
+    setup_logging(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    _raise_fd_limit()
+    _reset_metrics_dir()
+    listener = _listen()
+    if WORKERS <= 1:
+        serve(listener)
+        return
+
+    children = {}  # pid -> время запуска
+    stopping = False
+    failures = 0
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                serve(listener)
+                status = 0
+            except BaseException:
+                log.exception('Worker %s failed', os.getpid())
+            finally:
+                # Дописываем очередь логов: os._exit не вызывает atexit
+                logging.shutdown()
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    for _ in range(WORKERS):
+        spawn_worker()
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    exit_code = 0
+    while children:
+        pid, status = os.waitpid(-1, 0)
+        started = children.pop(pid, None)
+        if started is None:
+            # waitpid из gevent может вернуть уже обработанный процесс повторно
+            continue
+        uptime = time.monotonic() - started
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+        if stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if uptime >= MIN_UPTIME:
+            failures = 0
+        else:
+            # Падение сразу после старта (неверный DB_PATH, шарды и т.п.) - перезапуск не поможет сразу
+            failures += 1
+            if failures >= MAX_STARTUP_FAILURES:
+                log.error('Worker %s exited with code %s after %.1fs, %s startup failures in a row; stopping',
+                          pid, code, uptime, failures)
+                exit_code = 1
+                forward(signal.SIGTERM, None)
+                continue
+        delay = min(RESPAWN_MAX_DELAY, 0.5 * 2 ** (failures - 1)) if failures else 0.0
+        log.warning('Worker %s exited with code %s after %.1fs, restarting in %.1fs', pid, code, uptime, delay)
+        time.sleep(delay)
+        if not stopping:
+            spawn_worker()
+    if exit_code:
+        raise SystemExit(exit_code)
+
+
+if __name__ == '__main__':
+    main()